@@ -0,0 +1,54 @@
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+import os, sys, requests
+
+# the shared d42 session code lives next to the d42 lookup
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'lookup'))
+from d42_common import get_conf, device_facts, device_facts_missing
+
+
+class ActionModule(ActionBase):
+    """
+    Set the d42_device fact of a host from Device42, resolving whether Device42 knows
+    it by its fqdn or short name once:
+
+    - d42_device_facts:
+        name: "{{ inventory_hostname }}"
+        domain: .example.com
+        url: "https://{{ d42_hostname }}"
+
+    validate_certs (default D42_VERIFY, on) checks the certificate of Device42.
+    d42_device holds present, name, msg, type, hw_model, tags, ips, release_ips
+    (the non ipmi ips) and ports, the switch ports of physical devices. When the
+    device is missing or Device42 cannot be reached present is false and msg says why.
+    """
+
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset(('name', 'domain', 'url', 'username', 'password', 'macs', 'validate_certs'))
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        args = self._task.args
+        name = args.get('name') or (task_vars or {}).get('inventory_hostname')
+        verify = args.get('validate_certs')
+        conf = get_conf(args.get('url'), args.get('username'), args.get('password'),
+                        None if verify is None else boolean(verify, strict=False))
+        if not conf['D42_USER'] or not conf['D42_PWD']:
+            raise AnsibleError("Device42 credentials missing, set username/password or D42_USERNAME/D42_PASSWORD")
+
+        domain = args.get('domain', '.example.com')
+        try:
+            facts = device_facts(conf, name, domain, boolean(args.get('macs', True), strict=False))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # like a device missing from Device42, so d42_device is always set
+            facts = device_facts_missing(name, domain)
+            facts['msg'] = "Device42 request for %s failed: %s" % (name, e)
+
+        self._display.vvv("d42_device_facts: %s" % facts)
+        result['changed'] = False
+        result['ansible_facts'] = {'d42_device': facts}
+        return result
+
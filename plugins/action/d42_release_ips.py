@@ -0,0 +1,71 @@
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+import os, sys
+
+# the shared d42 session code lives next to the d42 lookup
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'lookup'))
+from d42_common import D42_WORKERS, get_conf, release_ips
+
+
+class ActionModule(ActionBase):
+    """
+    Release the ips of every host of the play in Device42 with one task:
+
+    - d42_release_ips:
+        fact: host_release_ips
+        url: "https://{{ d42_hostname }}"
+      run_once: true
+
+    ips are read from the `fact` of each of `hosts` (ansible_play_hosts by default)
+    that has it, or given directly as `ips`, and released `workers` at a time.
+    validate_certs (default D42_VERIFY, on) checks the certificate of Device42.
+    Returns results, {ip: {ok, status, msg}}, and hosts, {host: [ips]}.
+    """
+
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset(('ips', 'hosts', 'fact', 'url', 'username', 'password', 'workers', 'validate_certs'))
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+        task_vars = task_vars or {}
+
+        args = self._task.args
+        verify = args.get('validate_certs')
+        conf = get_conf(args.get('url'), args.get('username'), args.get('password'),
+                        None if verify is None else boolean(verify, strict=False))
+        if not conf['D42_USER'] or not conf['D42_PWD']:
+            raise AnsibleError("Device42 credentials missing, set username/password or D42_USERNAME/D42_PASSWORD")
+
+        if args.get('ips') is not None:
+            hosts = {}
+            ips = list(args['ips'])
+        else:
+            hosts = self._host_ips(task_vars, args.get('hosts'), args.get('fact', 'host_release_ips'))
+            ips = [ip for host_ips in hosts.values() for ip in host_ips]
+
+        results = release_ips(conf, ips, int(args.get('workers', D42_WORKERS)))
+        failed = sorted(ip for ip in results if not results[ip]['ok'])
+        self._display.vv("d42_release_ips: released %d of %d ips" % (len(results) - len(failed), len(results)))
+
+        result['changed'] = len(failed) < len(results)
+        result['results'] = results
+        result['hosts'] = hosts
+        if failed:
+            result['failed'] = True
+            result['msg'] = "Could not release %s" % ', '.join(failed)
+        return result
+
+    @staticmethod
+    def _host_ips(task_vars, hosts, fact):
+        # ips the play's hosts set in fact, hosts without it are skipped
+        hostvars = task_vars.get('hostvars', {})
+        if hosts is None:
+            hosts = task_vars.get('ansible_play_hosts', [])
+        found = {}
+        for host in hosts:
+            ips = hostvars.get(host, {}).get(fact)
+            if ips:
+                found[host] = list(ips)
+        return found
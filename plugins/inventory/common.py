@@ -1,93 +1,512 @@
 import os
 import re
+import json
+import codecs
+import time
+import hashlib
 import socket
+import tempfile
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LAN_PREFIXES = ['lan', 'vlan10', 'eth1', 'eth0', ]
+LAN_NETWORK = re.compile(r'^10\.')
+
+# settings for the shared lan resolver, overridable from the environment
+LAN_CACHE_PATH = os.path.expanduser(os.getenv('LAN_RESOLVER_CACHE', '~/.ansible/tmp/lan_resolver.json'))
+LAN_CACHE_TTL = int(os.getenv('LAN_RESOLVER_TTL', 3600))
+LAN_CACHE_NEGATIVE_TTL = int(os.getenv('LAN_RESOLVER_NEGATIVE_TTL', 300))
+LAN_RESOLVER_WORKERS = int(os.getenv('LAN_RESOLVER_WORKERS', 32))
+
+
+def load_json_cache(path):
+  ''' return the dict stored at path, or an empty one if it is missing or unreadable '''
+  try:
+    with open(path) as f:
+      data = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  if not isinstance(data, dict):
+    return {}
+  return data
+
+def save_json_cache(path, data):
+  ''' atomically replace the json file at path, cache write failures are not fatal '''
+  try:
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname or '.', prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f)
+    os.replace(tmp, path)
+  except (IOError, OSError):
+    return False
+  return True
+
+
+class LanResolver(object):
+  '''
+  resolves the lan name of many hosts at once
+
+  every prefix candidate of every host is probed concurrently on a bounded
+  thread pool, answers (and failures) are kept in a ttl bounded cache that is
+  persisted between inventory runs
+  '''
+
+  def __init__(self, cache_path=LAN_CACHE_PATH, ttl=LAN_CACHE_TTL,
+               negative_ttl=LAN_CACHE_NEGATIVE_TTL, workers=LAN_RESOLVER_WORKERS):
+    self.cache_path = cache_path
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.workers = max(1, workers)
+    self._lock = threading.Lock()
+    self._dirty = False
+    self._cache = {}
+    if self.cache_path:
+      self._cache = load_json_cache(self.cache_path)
+
+  @staticmethod
+  def candidates(hostname):
+    ''' names to try for a host, in order of preference '''
+    return [hostname] + ['%s.%s' % (prefix, hostname) for prefix in LAN_PREFIXES]
+
+  def _cached(self, name, now):
+    entry = self._cache.get(name)
+    if entry is None:
+      return False, None
+    ip, expires = entry
+    if expires < now:
+      return False, None
+    return True, ip
+
+  def _query(self, name):
+    try:
+      ip = socket.gethostbyname(name)
+    except (socket.gaierror, UnicodeError):
+      ip = None
+
+    ttl = self.ttl if ip else self.negative_ttl
+    with self._lock:
+      self._cache[name] = [ip, time.time() + ttl]
+      self._dirty = True
+    return ip
+
+  def lookup(self, names):
+    ''' return {name: ip or None}, resolving whatever is not cached '''
+    now = time.time()
+    answers = {}
+    missing = []
+    for name in names:
+      if name in answers:
+        continue
+      hit, ip = self._cached(name, now)
+      if hit:
+        answers[name] = ip
+      else:
+        answers[name] = None
+        missing.append(name)
+
+    if missing:
+      workers = min(self.workers, len(missing))
+      with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name, ip in zip(missing, pool.map(self._query, missing)):
+          answers[name] = ip
+
+    return answers
+
+  def resolve_many(self, hostnames):
+    '''
+    return {hostname: lan_hostname} for every hostname
+
+    the lan hostname is the first candidate (see candidates) resolving to a
+    10.x address, or the hostname itself when none does
+    '''
+    hostnames = list(hostnames)
+    names = []
+    for hostname in hostnames:
+      names.extend(self.candidates(hostname))
+    answers = self.lookup(names)
+
+    ret = {}
+    for hostname in hostnames:
+      ret[hostname] = hostname
+      for name in self.candidates(hostname):
+        ip = answers.get(name)
+        if ip and LAN_NETWORK.match(ip):
+          ret[hostname] = name
+          break
+
+    self.save()
+    return ret
+
+  def resolve(self, hostname):
+    return self.resolve_many([hostname])[hostname]
+
+  def save(self):
+    ''' write the cache back to disk, dropping expired entries '''
+    if not self._dirty or not self.cache_path:
+      return
+    now = time.time()
+    with self._lock:
+      self._cache = dict((k, v) for k, v in self._cache.items() if v[1] >= now)
+      data = dict(self._cache)
+      self._dirty = False
+    save_json_cache(self.cache_path, data)
+
+_lan_resolver = None
+
+def get_lan_resolver():
+  ''' process wide resolver, so every plugin shares one cache '''
+  global _lan_resolver
+  if _lan_resolver is None:
+    _lan_resolver = LanResolver()
+  return _lan_resolver
+
+def get_lan_hostnames(hostnames):
+  ''' resolve the lan hostname of many hosts concurrently, returns {hostname: lan_hostname} '''
+  return get_lan_resolver().resolve_many(hostnames)
 
 def get_lan_hostname(hostname):
-    ret = hostname
-    new_hostname = hostname
-    index = 0
-    prefixes = ['lan', 'vlan10', 'eth1', 'eth0', ]
-    resolved_ip = ''
+  return get_lan_resolver().resolve(hostname)
+
+_JSON_SEPARATOR = re.compile(r'[\s,]*')
+
+def iter_json_array(chunks, key=None):
+  '''
+  yield the items of a json array while its text is still arriving
+
+  chunks is any iterable of str or utf-8 bytes (e.g. response.iter_content()), only
+  the item being decoded is kept in memory. Without key the document must be an
+  array, with key the array is the value of the first "key" member in the document.
+  '''
+  decoder = json.JSONDecoder()
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  marker = '"{}"'.format(key) if key else None
+  started = False
+  buf = ''
+  pos = 0
+
+  for chunk in chunks:
+    if isinstance(chunk, bytes):
+      chunk = utf8.decode(chunk)
+    buf = buf[pos:] + chunk
+    pos = 0
+
+    if not started:
+      start = 0
+      if marker:
+        start = buf.find(marker)
+        if start < 0:
+          # keep enough text to spot a marker split across chunks
+          pos = max(0, len(buf) - len(marker))
+          continue
+        start += len(marker)
+      start = buf.find('[', start)
+      if start < 0:
+        continue
+      pos = start + 1
+      started = True
 
     while True:
-        try:
-            resolved_ip = socket.gethostbyname(new_hostname)
-        except socket.gaierror:
-            pass
+      pos = _JSON_SEPARATOR.match(buf, pos).end()
+      if pos >= len(buf):
+        break
+      if buf[pos] == ']':
+        return
+      try:
+        item, end = decoder.raw_decode(buf, pos)
+      except ValueError:
+        # item not complete yet
+        break
+      if not isinstance(item, (dict, list)) and (end == len(buf) or buf[end] not in ' \t\r\n,]'):
+        # a bare number may continue in the next chunk
+        break
+      pos = end
+      yield item
 
-        if re.match('^10\.', resolved_ip):
-            ret = new_hostname
-            break
-        if index >= len(prefixes):
-            break
+  raise ValueError('json array ended before its closing bracket')
 
-        new_hostname = '%s.%s' % (prefixes[index], hostname)
-        index = index+1
+def cache_key(module, *parts):
+  ''' inventory cache key for a plugin, derived from whatever selects its hosts (filters, endpoint, ...) '''
+  digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+  return '{}_{}'.format(module, digest)
 
-    return ret
+# inventory strings look like `module:key=value,key="quoted, value",key=[a, 'b'],key=value2`,
+# repeated keys collect their values into a list and bare values may contain `=`
+_INVENTORY_PAIR = re.compile(r"""
+    \s*(?P<key>[^=,\s]+)\s*=\s*
+    (?:
+        (?P<list>\[(?:[^\]"']|"(?:[^"\\]|\\.)*"|'[^']*')*\])
+      | "(?P<dquoted>(?:[^"\\]|\\.)*)"
+      | '(?P<squoted>[^']*)'
+      | (?P<bare>(?!["'])[^,]*?)
+    )\s*(?:,|$)
+""", re.X)
+_INVENTORY_ITEM = re.compile(r"""
+    \s*(?:"(?P<dquoted>(?:[^"\\]|\\.)*)"|'(?P<squoted>[^']*)'|(?P<bare>(?!["'])[^,]*?))\s*(?:,|$)
+""", re.X)
+_ESCAPE = re.compile(r'\\(.)')
+# keys whose values are never lists, `regex=[ab]` is a character class
+_SCALAR_KEYS = frozenset(('regex',))
+INVENTORY_STRING_CACHE_SIZE = 4096
+
+def _strip_cwd(path):
+    # ansible hands inventory strings over as paths below the current directory
+    for cwd in (os.environ.get('PWD'), os.getcwd()):
+      if cwd and path.startswith(cwd.rstrip('/') + '/'):
+        return path[len(cwd.rstrip('/')) + 1:]
+    return path
+
+def _value(match):
+    if match.group('dquoted') is not None:
+      return _ESCAPE.sub(r'\1', match.group('dquoted'))
+    if match.group('squoted') is not None:
+      return match.group('squoted')
+    return match.group('bare').strip()
+
+def _list_items(text):
+    items = []
+    text = text[1:-1]
+    pos = 0
+    while text[pos:].strip():
+      match = _INVENTORY_ITEM.match(text, pos)
+      items.append(_value(match))
+      pos = match.end()
+    return tuple(items)
+
+@functools.lru_cache(maxsize=INVENTORY_STRING_CACHE_SIZE)
+def _parse_inventory_string(param_string):
+    pairs = []
+    pos = 0
+    while param_string[pos:].strip():
+      match = _INVENTORY_PAIR.match(param_string, pos)
+      if match is None or match.end() == pos:
+        raise ValueError('invalid inventory string near {!r}, expected key=value'.format(param_string[pos:]))
+      if match.group('list') is not None and match.group('key') in _SCALAR_KEYS:
+        pairs.append((match.group('key'), match.group('list')))
+      elif match.group('list') is not None:
+        pairs.append((match.group('key'), _list_items(match.group('list'))))
+      else:
+        pairs.append((match.group('key'), _value(match)))
+      pos = match.end()
+    return tuple(pairs)
+
+@functools.lru_cache(maxsize=INVENTORY_STRING_CACHE_SIZE)
+def _verify_path(module, path):
+    return _strip_cwd(path).startswith(module)
 
 def verify_path(module, path):
     ''' return true/false if this is possibly a valid file for this plugin to consume '''
-    valid = False
-    path = re.sub('{}/'.format(os.environ['PWD']), '', path)
-    if path.startswith((module)):
-      valid = True
-
-    return valid
+    return _verify_path(module, path)
 
 def parse_path(module, path):
-    # strip module_name and split path into kv pairs
-    restr = '^{}:'.format(module)
-    path = re.sub('{}/'.format(os.environ['PWD']), '', path)
-    param_string = re.sub(restr, '', path)
-    param_string = re.sub(',$', '', param_string)
+    '''
+    strip module_name and parse the rest of the inventory string into a dict,
+    [a, b] lists (except for regex values) and repeated keys give list values
+    '''
+    path = _strip_cwd(path)
+    prefix = '{}:'.format(module)
+    if path.startswith(prefix):
+      path = path[len(prefix):]
+
     params = {}
+    for k, v in _parse_inventory_string(path):
+      v = list(v) if isinstance(v, tuple) else v
+      if k in params:
+        old = params[k] if isinstance(params[k], list) else [params[k]]
+        v = old + (v if isinstance(v, list) else [v])
+      params[k] = v
+
+    return params
+
+# hostnames remembered by parsehost, inventories parse the same names over and over
+PARSEHOST_CACHE_SIZE = int(os.getenv('PARSEHOST_CACHE_SIZE', 200000))
+_NODE_NUMBER = re.compile(r'\d')
 
-    if re.search(',', param_string):
-        param_pairs = param_string.split(',')
+@functools.lru_cache(maxsize=PARSEHOST_CACHE_SIZE)
+def _parsehost(hostname):
+    host = hostname.replace('example.com','').lower()
+
+    split_host = host.split('.')
+    if len(split_host) == 4:
+      subnode = split_host[1]
+      del split_host[1]
     else:
-        param_pairs = [ param_string ]
-  
-    for pair in param_pairs:
-        k, v = pair.split('=')
-        if k:
-            params[k] = v
+      subnode = None
 
-    return params
+    # too few labels to tell node, product and site apart
+    if len(split_host) < 3:
+      return ('ungrouped',)
 
-# creates groups based on civ2 puppet style fqdn splitting  
+    node, product, site = split_host[:3]
+    match = _NODE_NUMBER.search(node)
+    if match != None:
+      node_name = node[:match.start()]
+    else:
+      node_name = node
+
+    if subnode != None:
+      groups = (node_name,product,site,subnode)
+    else:
+      groups = (node_name,product,site)
+
+    return tuple(g for g in groups if g != '')
+
+# creates groups based on civ2 puppet style fqdn splitting
 def parsehost(hostname):
-    host = hostname.replace('example.com','').lower()
+    return list(_parsehost(hostname))
+
+def group_hosts(hosts):
+    '''
+    bulk parsehost: returns {group: set(hosts)} for many hosts at once
 
+    hosts is a list of hostnames, or a {hostname: inventory_hostname} dict when
+    hosts are grouped by one name and added to the inventory under another
+    '''
+    if not isinstance(hosts, dict):
+      hosts = dict((h, h) for h in hosts)
+    graph = {}
+    for hostname, inventory_hostname in hosts.items():
+      for g in _parsehost(hostname):
+        members = graph.get(g)
+        if members is None:
+          members = graph[g] = set()
+        members.add(inventory_hostname)
+    return graph
+
+def populate(inventory, graph):
+    '''
+    add a {group: set(hosts)} graph to an ansible inventory
+
+    every group and every host goes through InventoryData once, memberships are then
+    added on the Group objects, skipping the per membership work of add_host and
+    add_child. InventoryData rebuilds its groups view when the source is reconciled
+    '''
+    hosts = {}
+    for g, members in graph.items():
+      group = inventory.groups[inventory.add_group(g)]
+      for h in members:
+        host = hosts.get(h)
+        if host is None:
+          host = hosts[h] = inventory.hosts[inventory.add_host(h)]
+        group.add_host(host)
+
+if __name__ == '__main__':
+    # checks of the inventory string parser and hostname grouping, then a micro-benchmark
+    # of hostname parsing and inventory population: python common.py [hostnames] [inventory hosts]
+    import sys
+
+    assert parse_path('puppet', 'puppet:class=role::web,fact=virtual,value=physical,') == \
+      {'class': 'role::web', 'fact': 'virtual', 'value': 'physical'}
+    assert parse_path('puppet', 'puppet:class=[a, "b,c"],class=d') == {'class': ['a', 'b,c', 'd']}
+    assert parse_path('sensu', 'sensu:check="CORE_disk, x",state=WARNING..CRITICAL') == \
+      {'check': 'CORE_disk, x', 'state': 'WARNING..CRITICAL'}
+    assert parse_path('sensu', "sensu:operator=>=,state='OK'") == {'operator': '>=', 'state': 'OK'}
+    assert parse_path('puppet', 'puppet:regex=[ab]') == {'regex': '[ab]'}
+    assert parse_path('puppet', 'puppet:regex=[ab]c,regex=^d') == {'regex': ['[ab]c', '^d']}
+    assert parse_path('puppet', 'puppet:q=a=b') == {'q': 'a=b'}
+    assert parse_path('puppet', '{}/puppet:class=x'.format(os.getcwd())) == {'class': 'x'}
     try:
-      split_host = host.split('.')
-      if len(split_host) == 4:
-        subnode = split_host[1]
-        del split_host[1]
-      else:
-        subnode = None
-
-      node = split_host[0]
-      product = split_host[1]
-      site = split_host[2]
-      match = re.search(r'\d', node)
-      if match != None:
-        number_start = match.start()
-        node_name = node[:number_start]
-        node_number = node[number_start:]
-      else:
-        node_number = None
-        node_name = node
+      parse_path('puppet', 'puppet:class')
+      raise AssertionError('a key without value was accepted')
+    except ValueError:
+      pass
+    assert verify_path('puppet', 'puppet:class=x') and not verify_path('puppet', 'sensu:check=x')
+    assert set(parsehost('web1.prod.site2.example.com')) == {'web', 'prod', 'site2'}
+    assert set(parsehost('db1.c1.prod.site3.example.com')) == {'db', 'c1', 'prod'}
+    assert parsehost('NODE1.site2') == ['ungrouped']
+    assert group_hosts(['web1.prod.site2.example.com', 'web2.prod.site2.example.com'])['web'] == \
+      {'web1.prod.site2.example.com', 'web2.prod.site2.example.com'}
 
-      groups = [node_name,product,site]
-      if subnode != None:
-        groups = [node_name,product,site,subnode]
-      else:
-        groups = [node_name,product,site]
-    except:
-        # catch exceptions with indexes out of range when trying to parse hostname
+    def legacy_parsehost(hostname):
+      host = hostname.replace('example.com','').lower()
+      try:
+        split_host = host.split('.')
+        if len(split_host) == 4:
+          subnode = split_host[1]
+          del split_host[1]
+        else:
+          subnode = None
+        node = split_host[0]
+        product = split_host[1]
+        site = split_host[2]
+        match = re.search(r'\d', node)
+        if match != None:
+          node_name = node[:match.start()]
+        else:
+          node_name = node
+        if subnode != None:
+          groups = [node_name,product,site,subnode]
+        else:
+          groups = [node_name,product,site]
+      except:
         groups = ['ungrouped']
-      
-        
-    groups = [g for g in groups if g != '']
-    return groups
+      return [g for g in groups if g != '']
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    shapes = ['web{0}.prod{1}.site{2}.example.com', 'db{0}.c{1}.prod{1}.site{2}.example.com', 'NODE{0}.site{2}', 'lb{0}.edge.site{2}.example.com']
+    corpus = [shapes[i % len(shapes)].format(i % 25000, i % 40, i % 6) for i in range(count)]
+
+    for name, parse in (('legacy parsehost', legacy_parsehost), ('parsehost', parsehost)):
+      _parsehost.cache_clear()
+      start = time.time()
+      graph = {}
+      for h in corpus:
+        for g in parse(h):
+          graph.setdefault(g, set()).add(h)
+      sys.stdout.write('{:<20} {} hostnames in {:.3f}s\n'.format(name, count, time.time() - start))
+
+    _parsehost.cache_clear()
+    start = time.time()
+    assert group_hosts(corpus) == graph
+    sys.stdout.write('{:<20} {} hostnames in {:.3f}s\n'.format('group_hosts', count, time.time() - start))
+    start = time.time()
+    group_hosts(corpus)
+    sys.stdout.write('{:<20} {} hostnames in {:.3f}s\n'.format('group_hosts (warm)', count, time.time() - start))
+
+    def legacy_parse_path(module, path):
+      restr = '^{}:'.format(module)
+      path = re.sub('{}/'.format(os.environ['PWD']), '', path)
+      param_string = re.sub(restr, '', path)
+      param_string = re.sub(',$', '', param_string)
+      params = {}
+      for pair in param_string.split(','):
+        k, v = pair.split('=')
+        if k:
+          params[k] = v
+      return params
+
+    os.environ.setdefault('PWD', os.getcwd())
+    sources = ['{}/puppet:class=role::web{},fact=virtual,value=physical,'.format(os.environ['PWD'], i % 2000) for i in range(count)]
+    for name, parse in (('legacy parse_path', legacy_parse_path), ('parse_path', parse_path)):
+      _parse_inventory_string.cache_clear()
+      start = time.time()
+      for src in sources:
+        parse('puppet', src)
+      sys.stdout.write('{:<20} {} sources in {:.3f}s\n'.format(name, count, time.time() - start))
+
+    from ansible.inventory.data import InventoryData
+
+    def legacy_populate(inventory, hosts):
+      for h in hosts:
+        for g in parsehost(h):
+          inventory.add_group(g)
+          inventory.add_host(h, group=g)
+
+    def bulk_populate(inventory, hosts):
+      populate(inventory, group_hosts(hosts))
+
+    hosts = corpus[:int(sys.argv[2]) if len(sys.argv) > 2 else 50000]
+    for name, run in (('add_host per group', legacy_populate), ('populate', bulk_populate)):
+      # best of 5 from a cold parsehost cache, the machine noise is larger than the difference
+      timings = []
+      for _ in range(5):
+        _parsehost.cache_clear()
+        inventory = InventoryData()
+        start = time.time()
+        run(inventory, hosts)
+        timings.append(time.time() - start)
+      sys.stdout.write('{:<20} {} hosts in {:.3f}s\n'.format(name, len(hosts), min(timings)))
+    sys.stdout.flush()
@@ -9,6 +9,7 @@ import json
 import os
 import pdb
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # add . to search path so we can find our common lib stuff
 from os.path import dirname
@@ -39,6 +40,20 @@ DOCUMENTATION = '''
         description: device42 password
       d42_endpoint:
         description: device42 base URL
+      filters:
+        description: device42 device search filters, also used as the inventory cache key
+        type: dict
+        default: {}
+      page_size:
+        description: number of devices requested per page of the device search
+        type: int
+        default: 1000
+      page_workers:
+        description: number of pages fetched concurrently
+        type: int
+        default: 4
+    extends_documentation_fragment:
+      - inventory_cache
 
 '''
 
@@ -50,6 +65,10 @@ filters:
   tags_and:
     - puppet
     - tym
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.ansible/tmp/d42_inventory
+cache_timeout: 3600
 '''
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
@@ -73,8 +92,6 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     config = self._read_config_data(path)
     self.display.vvv('{}'.format(config))
 
-    self.dologin(path)
-
     params = {}
     for f in config['filters']:
       if isinstance(config['filters'][f], list):
@@ -83,15 +100,73 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         params[f] = config['filters'][f]
 
     self.display.vvv('{}'.format(params))
+
+    # the host/group graph is cached per filter set, `cache=False` means the cache is being flushed
+    cache_key = common.cache_key(self.NAME, self.get_option('d42_endpoint'), params)
+    user_cache_setting = self.get_option('cache')
+    attempt_to_read_cache = user_cache_setting and cache
+    cache_needs_update = user_cache_setting and not cache
+
+    graph = None
+    if attempt_to_read_cache:
+      try:
+        graph = self._cache[cache_key]
+        self.display.vvv('using cached device42 inventory {}'.format(cache_key))
+        self.populate(graph)
+      except KeyError:
+        cache_needs_update = True
+
+    if graph is None:
+      graph = self.fetch_graph(path, params)
+
+    if cache_needs_update:
+      self._cache[cache_key] = dict((g, sorted(graph[g])) for g in graph)
+
+  def fetch_graph(self, path, params):
+    '''
+    page through the device search, adding hosts to the inventory as each page arrives
+    '''
+    self.dologin(path)
+
+    page_size = self.get_option('page_size')
+    query = dict(params, include_cols='name', limit=page_size, offset=0)
+
+    graph = {}
+    first = self.search_page(query)
+    self.add_page(graph, first)
+
+    # servers that ignore paging answer with everything and no total_count
+    total = first.get('total_count', 0)
+    offsets = range(page_size, total, page_size)
+    if offsets:
+      with ThreadPoolExecutor(max_workers=self.get_option('page_workers')) as pool:
+        pages = [pool.submit(self.search_page, dict(query, offset=offset)) for offset in offsets]
+        for page in as_completed(pages):
+          self.add_page(graph, page.result())
+
+    return graph
+
+  def search_page(self, query):
     try:
-      device = Device.search(self.api, params)
+      device = Device.search(self.api, query)
       self.display.vvvvv(device)
     except Exception as e:
-      self.display.error(e)
-      exit
+      raise AnsibleError('device42 device search failed: {}'.format(e))
 
+    try:
+      return json.loads(device)
+    except (TypeError, ValueError):
+      #if device is an already parsed into python object
+      return device
+
+  def add_page(self, graph, page):
+    page_graph = self.parse_json(page)
+    self.populate(page_graph)
+    for g in page_graph:
+      graph.setdefault(g, set()).update(page_graph[g])
 
-    self.parse_json(device)
+  def populate(self, graph):
+    common.populate(self.inventory, graph)
 
 
   def dologin(self, path):
@@ -130,7 +205,7 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
       else:
         return True
 
-  # parses device names from device 42 devices api json response
+  # parses device names from device 42 devices api json response into {group: set(hosts)}
   def parse_json(self, inventory):
     self.display.vvv('{}'.format(inventory))
     try:
@@ -149,10 +224,5 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
       name = device_names[i]
       if 'example.com' not in name:
         device_names[i] = name+'.example.com'
-    for h in device_names:
-      groups = common.parsehost(h)
-      for g in groups:
-        g=g.lower()
-        h=h.lower()
-        self.inventory.add_group(g)
-        self.inventory.add_host(h,group=g)
+
+    return common.group_hosts(dict((h, h.lower()) for h in device_names))
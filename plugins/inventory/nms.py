@@ -16,6 +16,8 @@ import json
 import requests
 import argparse
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from ansible.module_utils._text import to_native
 
 # add . to search path so we can find our common lib stuff
@@ -25,6 +27,11 @@ import common
 
 display = Display()
 
+# LibreNMS os name to ansible_network_os
+NETWORK_OS = { "arista_eos": "eos" }
+NMS_OS = re.compile("^([a-zA-Z]*).*")
+STREAM_CHUNK_SIZE = 256 * 1024
+
 DOCUMENTATION = '''
     name: nms
     plugin_type: inventory
@@ -46,6 +53,26 @@ DOCUMENTATION = '''
         description: nms endpoint
       api_key:
         description: nms api key
+      api_fields:
+        description: device fields requested from the api, only hostname and os are used
+        default: hostname,os
+      page_size:
+        description: devices per page, pages are requested with limit/offset. 0 fetches all devices in one request
+        type: int
+        default: 0
+      page_workers:
+        description: number of pages fetched concurrently
+        type: int
+        default: 4
+      revalidate_after:
+        description:
+          - seconds a cached device list is used without asking the api.
+          - after that it is revalidated with If-None-Match/If-Modified-Since, a 304 keeps the cached list.
+          - conditional requests are only made when page_size is 0.
+        type: int
+        default: 300
+    extends_documentation_fragment:
+      - inventory_cache
 '''
 
 EXAMPLES = '''
@@ -54,6 +81,11 @@ api_user: rancid
 api_pw: xxxxxxxxxxxx
 api_endpoint: https://nms1.example.com/api/v0/devices
 api_key: xxxxxxxxxxxxxxx
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.ansible/tmp/nms_inventory
+cache_timeout: 86400
+revalidate_after: 300
 '''
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
@@ -62,6 +94,8 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
   def __init__(self):
     super(InventoryModule, self).__init__()
     self.api = None
+    self.use_cache = False
+    self.update_cache = False
 
 
   def verify_file(self, path):
@@ -76,43 +110,143 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     config = self._read_config_data(path)
     self.display.vvv('{}'.format(config))
 
+    # `cache=False` means the cache is being flushed, refetch but still store the result
+    self.use_cache = self.get_option('cache') and cache
+    self.update_cache = self.get_option('cache')
+
     self.get_nms()
 
   def libresNMS(self, api_endpoint, api_key, userid, password):
-    switch = { "arista_eos": "eos" }
     s = requests.Session()
     s.auth = (userid, password)
-    headers = { 'X-Auth-Token': api_key, }
+    s.headers.update({ 'X-Auth-Token': api_key, })
+    self.network_os = {}
+
+    params = { 'columns': self.get_option('api_fields') }
+    page_size = self.get_option('page_size')
+
+    cache_key = common.cache_key(self.NAME, api_endpoint, userid)
+    cached = None
+    if self.use_cache:
+      try:
+        cached = self._cache[cache_key]
+      except KeyError:
+        pass
+
+    if cached and time.time() - cached['fetched_at'] <= self.get_option('revalidate_after'):
+      self.display.vvv('using cached nms devices')
+      self.add_devices(cached['devices'])
+      return
 
     try:
-      r = s.get(api_endpoint, headers=headers)
-      devices = json.loads(r.text)
+      if not page_size:
+        headers = {}
+        if cached:
+          if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+          if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        devices, validators = self.get_devices(s, api_endpoint, params, headers)
+        if devices is None:
+          self.display.vvv('nms devices not modified, using cache')
+          devices = cached['devices']
+          validators = dict(cached, **validators)
+        self.add_devices(devices)
+      else:
+        # pages are added to the inventory as they arrive
+        devices, validators = self.get_paged_devices(s, api_endpoint, params, page_size), {}
 
     except Exception as e:
+       if cached:
+         display.warning("NMS devices could not be revalidated, using the cache from %.0fs ago: %s" % (time.time() - cached['fetched_at'], to_native(e)))
+         self.add_devices(cached['devices'])
+         return
        display.debug("Something is wrong. NMS not returning valid devices. Check API_URL, API_KEY, API_USER, and API_PASSWORD. %s" % to_native(e))
        return
 
-    for device in devices['devices']:
-        nms_os = re.match("^([a-zA-Z]*).*", device['os']).group(0)
-        ansible_network_os = switch.get(nms_os, nms_os)
-        
-        try:
-          hostname = device['hostname']
-          groups = common.parsehost(hostname)
+    if self.update_cache:
+      self._cache[cache_key] = {
+        'etag': validators.get('etag'),
+        'last_modified': validators.get('last_modified'),
+        'fetched_at': time.time(),
+        'devices': devices,
+      }
 
-          for g in groups:
-            g=g.lower()
-            h=hostname.lower()
-            self.inventory.add_group(g)
-            self.inventory.add_host(h,group=g)
+    return
 
-          self.inventory.add_group(ansible_network_os)
-          self.inventory.add_host(h, group=ansible_network_os)
+  def get_paged_devices(self, s, api_endpoint, params, page_size):
+    # LibreNMS does not report a total, fetch waves of pages until one comes back short
+    workers = self.get_option('page_workers')
+    devices = []
+    offset = 0
+    previous_first = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      while True:
+        pages = [pool.submit(self.get_devices, s, api_endpoint, dict(params, limit=page_size, offset=offset + i * page_size))
+                 for i in range(workers)]
+        counts = []
+        for page in pages:
+          page_devices = page.result()[0]
+          # a page larger than asked for means the api ignored the paging and every
+          # page of the wave is the whole device list, keep only the first copy
+          if len(page_devices) > page_size:
+            self.display.vvv('nms api ignored paging, using the first full device list')
+            for other in pages:
+              other.cancel()
+            self.add_devices(page_devices)
+            return page_devices
+          # so does a page starting where the previous one did, when exactly page_size
+          # devices exist every page would be full and the paging would never end
+          if page_devices and page_devices[0] == previous_first:
+            self.display.vvv('nms api ignored paging, the device list fits one page')
+            for other in pages:
+              other.cancel()
+            return devices
+          previous_first = page_devices[0] if page_devices else None
+          self.add_devices(page_devices)
+          devices.extend(page_devices)
+          counts.append(len(page_devices))
+        offset += workers * page_size
+        if min(counts) < page_size:
+          return devices
 
-        except KeyError:
-           self.inventory.add_group(ansible_network_os)
+  def get_devices(self, s, api_endpoint, params, headers=None):
+    '''
+    stream the device list, keeping only hostname and os of each device.
+    returns (devices, cache validators), devices is None when the server answers 304
+    '''
+    r = s.get(api_endpoint, params=params, headers=headers, stream=True)
+    try:
+      validators = {}
+      if r.headers.get('ETag'):
+        validators['etag'] = r.headers['ETag']
+      if r.headers.get('Last-Modified'):
+        validators['last_modified'] = r.headers['Last-Modified']
+      if r.status_code == 304:
+        return None, validators
+      r.raise_for_status()
+      return [[device.get('hostname'), device['os']]
+              for device in common.iter_json_array(r.iter_content(STREAM_CHUNK_SIZE), key='devices')], validators
+    finally:
+      r.close()
 
-    return
+  def get_network_os(self, nms_os):
+    if nms_os not in self.network_os:
+      name = NMS_OS.match(nms_os).group(0)
+      self.network_os[nms_os] = NETWORK_OS.get(name, name)
+    return self.network_os[nms_os]
+
+  def add_devices(self, devices):
+    named = dict((hostname, hostname.lower()) for hostname, nms_os in devices if hostname is not None)
+    graph = common.group_hosts(named)
+    for hostname, nms_os in devices:
+      members = graph.setdefault(self.get_network_os(nms_os), set())
+      if hostname is not None:
+        members.add(named[hostname])
+
+    common.populate(self.inventory, graph)
+
+    return len(devices)
 
   def getArgs(self):
     # setup LibresNMS API 
@@ -1,28 +1,271 @@
-#!/usr/bin/env python3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
+from ansible.errors import AnsibleError
+from ansible.utils.display import Display
+display = Display()
+
+import os
+import re
 import sys
+import requests
 
-from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
+# add . to search path so we can find our common lib stuff
+from os.path import dirname
+sys.path.append(dirname(__file__))
+import common as lib
 
-class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+DOCUMENTATION = r'''
+    name: prometheus
+    plugin_type: inventory
+    short_description: loads hosts from the targets prometheus is scraping
+    description:
+        - Builds host groups from the prometheus targets api, or from the series returned by a PromQL query such as C(up{job="node"}).
+        - Hosts come from the I(host_label) label with its port stripped, and are grouped like every other inventory (see common.parsehost).
+        - Accepts a C(*prometheus.yaml) file or an inventory string beginning with the module's name, e.g. C(prometheus:job=node,env=prod).
+        - Extra keys in the inventory string are label matchers for an C(up) query, a list value such as C(env=[prod, stage]) matches any of its values.
+    options:
+      plugin:
+        required: true
+        choices: ['prometheus']
+        description: token to ensure using prometheus plugin
+      prometheus_url:
+        description: prometheus base URL, defaults to PROMETHEUS_URL
+      query:
+        description: PromQL query whose series are the hosts, the targets api is used when unset
+      host_label:
+        description: label holding the host name
+        default: instance
+      group_labels:
+        description: labels whose values become groups
+        type: list
+        default: []
+      alive_only:
+        description: only keep targets whose health is up, or query samples whose value is 1
+        type: bool
+        default: true
+      timeout:
+        description: seconds to wait for prometheus
+        type: int
+        default: 30
+    extends_documentation_fragment:
+      - inventory_cache
+'''
+
+EXAMPLES = r'''
+plugin: prometheus
+prometheus_url: http://prometheus.example.com:9090
+query: up{job="node"}
+group_labels:
+  - job
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.ansible/tmp/prometheus_inventory
+cache_timeout: 300
 
-  NAME = 'myplugin'
+All live node_exporter hosts of the web product
+# ansible-playbook -i 'prometheus:job=node,product=web' ...
+'''
+
+PROMETHEUS_URL = os.getenv('PROMETHEUS_URL', 'http://prometheus.example.com:9090')
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# options that are not label matchers in an inventory string
+STRING_OPTIONS = ('prometheus_url', 'query', 'host_label', 'group_labels', 'alive_only', 'timeout')
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
-  def parse():
-    self.inventory.add_host('puppet0.example.com')
+  NAME = 'prometheus'
 
   def verify_file(self, path):
-      ''' return true/false if this is possibly a valid file for this plugin to consume '''
-      valid = False
-      if super(InventoryModule, self).verify_file(path):
-          # base class verifies that file exists and is readable by current user
-          if path.endswith(('virtualbox.yaml', 'virtualbox.yml', 'vbox.yaml', 'vbox.yml', 'something')):
-              valid = True
-      return valid
+    # if it starts with prometheus:
+    if lib.verify_path(self.NAME, path):
+      return True
+
+    if super(InventoryModule, self).verify_file(path):
+      if path.endswith(('prometheus.yaml', 'prometheus.yml')):
+        return True
+    display.debug("prometheus inventory filename must end with 'prometheus.yaml' or 'prometheus.yml'")
+    return False
+
+  def parse(self, inventory, loader, path, cache=True):
+    self.loader = loader
+    self.inventory = inventory
+
+    try: # the default ansible parser for yaml file values
+      super(InventoryModule, self).parse(inventory, loader, path, cache)
+      self._read_config_data(path)
+      params = dict((option, self.get_option(option)) for option in STRING_OPTIONS)
+      use_cache = self.get_option('cache')
+
+    except Exception: # we're passing values with input string
+      params = self._string_params(lib.parse_path(self.NAME, path))
+      use_cache = False
+    self.display.vvv('{}'.format(params))
+
+    # `cache=False` means the cache is being flushed
+    cache_key = lib.cache_key(self.NAME, params)
+    graph = None
+    if use_cache and cache:
+      try:
+        graph = self._cache[cache_key]
+      except KeyError:
+        pass
+
+    if graph is None:
+      graph = self.get_graph(params)
+      if use_cache:
+        self._cache[cache_key] = graph
+
+    lib.populate(self.inventory, graph)
+
+  def _string_params(self, params):
+    '''
+    defaults for an inventory string, other keys become an up{...} query
+    '''
+    matchers = dict((k, v) for k, v in params.items() if k not in STRING_OPTIONS)
+    ret = {
+      'prometheus_url': params.get('prometheus_url'),
+      'query': params.get('query'),
+      'host_label': params.get('host_label', 'instance'),
+      'group_labels': split_list(params.get('group_labels')),
+      'alive_only': str(params.get('alive_only', 'true')).lower() in ('1', 'true', 'yes'),
+      'timeout': int(params.get('timeout', 30)),
+    }
+    if matchers and not ret['query']:
+      ret['query'] = 'up{{{}}}'.format(','.join(label_matcher(k, v) for k, v in sorted(matchers.items())))
+    return ret
+
+  def get_graph(self, params):
+    '''
+    {group: [hosts]} of the targets or query series
+    '''
+    url = (params['prometheus_url'] or PROMETHEUS_URL).rstrip('/')
+    if params['query']:
+      url += '/api/v1/query'
+      request = {'query': params['query']}
+      key = 'result'
+    else:
+      url += '/api/v1/targets'
+      request = {'state': 'active'}
+      key = 'activeTargets'
+
+    self.display.vvv('about to hit api call ({} {})'.format(url, request))
+    graph = {}
+    try:
+      r = requests.get(url, params=request, stream=True, timeout=params['timeout'])
+      try:
+        r.raise_for_status()
+        for series in lib.iter_json_array(r.iter_content(STREAM_CHUNK_SIZE), key=key):
+          self._add_series(graph, series, params)
+      finally:
+        r.close()
+    except (requests.exceptions.RequestException, ValueError) as e:
+      raise AnsibleError('prometheus request {} failed: {}'.format(url, e))
+
+    return dict((g, sorted(graph[g])) for g in graph)
+
+  def _add_series(self, graph, series, params):
+    # targets carry labels and health, query results a metric and a [ts, value] sample
+    if 'labels' in series:
+      labels = series['labels']
+      alive = series.get('health') == 'up'
+    else:
+      labels = series.get('metric', {})
+      alive = series.get('value', [None, None])[1] == '1'
+
+    if params['alive_only'] and not alive:
+      return
+    host = labels.get(params['host_label'])
+    if not host:
+      return
+    host = strip_port(host).lower()
+
+    groups = lib.parsehost(host)
+    for label in params['group_labels']:
+      if labels.get(label):
+        groups.append(re.sub(r'\W', '_', labels[label]).lower())
+    for g in groups:
+      graph.setdefault(g, set()).add(host)
+
+def strip_port(instance):
+  ''' host part of an instance label: host:9100 and [::1]:9100 '''
+  match = re.match(r'^\[(.*)\](:\d+)?$', instance)
+  if match:
+    return match.group(1)
+  if instance.count(':') == 1:
+    return instance.split(':')[0]
+  return instance
+
+def label_matcher(label, value):
+  ''' label="value", or label=~"a|b" for a list value '''
+  if isinstance(value, list):
+    return '{}=~"{}"'.format(label, '|'.join(re.escape(str(v)).replace('\\', '\\\\').replace('"', '\\"') for v in value))
+  return '{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+def split_list(value):
+  ''' list option from an inventory string value '''
+  if value is None:
+    return []
+  if isinstance(value, list):
+    return value
+  return [v for v in value.split('|') if v]
 
 if __name__ == '__main__':
-    inventory = {}
-    enterprise = {}
+    # self test against a local stand-in prometheus: python prometheus.py [targets]
+    import json
+    import threading
+    try:
+      from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+      from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    targets = [{'labels': {'instance': 'web{}.prod.site{}.example.com:9100'.format(i, i % 3), 'job': 'node'},
+                'health': 'up' if i % 10 else 'down'} for i in range(count)]
+
+    class StandIn(BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = json.dumps({'status': 'success', 'data': {'activeTargets': targets, 'droppedTargets': []}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    assert strip_port('web1.example.com:9100') == 'web1.example.com'
+    assert strip_port('[::1]:9100') == '::1'
+    assert strip_port('fe80::1') == 'fe80::1'
+    assert label_matcher('job', 'node') == 'job="node"'
+    assert label_matcher('env', ['prod', 'a.b']) == 'env=~"prod|a\\\\.b"'
+    assert split_list('job|env') == ['job', 'env'] and split_list(None) == []
+
+    plugin = InventoryModule()
+    params = plugin._string_params({'job': 'node', 'env': ['prod', 'stage'], 'group_labels': 'job', 'alive_only': 'no'})
+    assert params['query'] == 'up{env=~"prod|stage",job="node"}', params['query']
+    assert params['group_labels'] == ['job'] and params['alive_only'] is False and params['host_label'] == 'instance'
+    assert plugin._string_params({'query': 'up', 'job': 'node'})['query'] == 'up'
+
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever).start()
+    try:
+      params = {'prometheus_url': 'http://127.0.0.1:{}'.format(server.server_port), 'query': None,
+                'host_label': 'instance', 'group_labels': ['job'], 'alive_only': True, 'timeout': 5}
+      graph = plugin.get_graph(params)
+      every_graph = plugin.get_graph(dict(params, alive_only=False))
+    finally:
+      server.shutdown()
+
+    # every tenth target is down, hosts lose their port and are grouped by name and job
+    alive = ['web{}.prod.site{}.example.com'.format(i, i % 3) for i in range(count) if i % 10]
+    assert graph['node'] == sorted(alive), 'alive targets are not the node group'
+    assert graph['web'] == sorted(alive) and graph['prod'] == sorted(alive)
+    assert sum(len(graph['site{}'.format(i)]) for i in range(3) if 'site{}'.format(i) in graph) == len(alive)
+    assert len(every_graph['node']) == count
 
-    # return to ansible
-    sys.stdout.write(str(inventory))
-    sys.stdout.flush()
\ No newline at end of file
+    sys.stdout.write(json.dumps(dict((g, len(graph[g])) for g in graph), sort_keys=True) + '\n')
+    sys.stdout.write('prometheus self test passed\n')
+    sys.stdout.flush()
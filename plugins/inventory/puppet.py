@@ -7,6 +7,7 @@ import socket
 import inspect
 import pypuppetdb
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from ansible.plugins.inventory import BaseInventoryPlugin,Cacheable, Constructable
 from ansible.errors import AnsibleError
@@ -27,6 +28,10 @@ DOCUMENTATION = r'''
     description:
         - Parses a host string with keywords to do a lookup
         - This plugin only applies to inventory strings that are not paths and begin with the module's name
+        - Every selector given (regex, class, fact/value, resource) is a PuppetDB query, they run concurrently over one PuppetDB connection.
+        - The selectors of an inventory string (or of one entry of `queries`) are combined by its match, all (default) returns the intersection of their hosts, any their union.
+        - A pdb.yaml file can list several queries under `queries`, the top level match=any (default) returns the union of their hosts, match=all their intersection.
+        - fact and value are paired in order, each fact needs a value. Booleans and numbers match typed facts, a string such as `true` or `8` matches the string and the typed fact.
 '''
 
 EXAMPLES = r'''
@@ -36,6 +41,20 @@ To restart the puppet agent on all puppetdb servers
 To do the same on all physical nodes, skipping virtual machines
 # ansible-playbook -i 'puppet:fact=virtual,value=physical' ~/Code/stash.example.com/ANSB/role-puppet/tasks/restart-agent.yml
 
+Physical puppetdb servers only
+# ansible-playbook -i 'puppet:class=roles::cloudops::puppet::database,fact=virtual,value=physical' ...
+
+Puppetdb servers and physical nodes
+# ansible-playbook -i 'puppet:class=roles::cloudops::puppet::database,fact=virtual,value=physical,match=any' ...
+
+A decommission wave in a wave.pdb.yaml file
+plugin: puppet
+queries:
+  - class: roles::legacy::web
+  - fact: virtual
+    value: physical
+  - regex: ^old-
+match: any
 '''
 
 
@@ -53,6 +72,12 @@ if os.getenv('FABRIC_PDB_SSL_CERT', False):
 if os.getenv('FABRIC_PDB_SSL_KEY', False):
     pdb_ssl_key = os.getenv('FABRIC_PDB_SSL_KEY')
 
+# certnames fetched per PQL page
+PDB_PAGE_SIZE = int(os.getenv('PDB_PAGE_SIZE', 1000))
+PQL_OPERATORS = ('=', '!=', '<', '<=', '>', '>=', '~')
+# queries of one inventory run concurrently
+PDB_QUERY_WORKERS = int(os.getenv('PDB_QUERY_WORKERS', 4))
+
 def connect_pdb():
   pdb = pypuppetdb.connect(
       host=PUPPETDB_API,
@@ -62,18 +87,62 @@ def connect_pdb():
 
   return pdb
 
+def pql_string(value):
+  ''' quote a value as a PQL string literal '''
+  return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+PQL_NUMBER = re.compile(r'^-?\d+(\.\d+)?$')
+
+def pql_typed(value):
+  ''' the unquoted PQL literal of a bool or number, or of a string spelling one, else None '''
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if isinstance(value, (int, float)):
+    return str(value)
+  value = str(value)
+  if value in ('true', 'false') or PQL_NUMBER.match(value):
+    return value
+  return None
+
+def pql_value(operator, value):
+  '''
+  PQL condition on a fact value. Bools and numbers are unquoted, strings that spell one
+  match the string fact as well as the typed one since inventory strings carry no types
+  '''
+  typed = pql_typed(value)
+  if typed is None or operator == '~':
+    return 'value {} {}'.format(operator, pql_string(value))
+  if not isinstance(value, str) or operator not in ('=', '!='):
+    return 'value {} {}'.format(operator, typed)
+  either = '(value = {} or value = {})'.format(pql_string(value), typed)
+  return either if operator == '=' else '!' + either
+
+def pql_certnames(entity, conditions, limit, offset):
+  ''' PQL page of the certnames of entity matching conditions, one row per host '''
+  return '{}[certname] {{ {} group by certname order by certname limit {} offset {} }}'.format(entity, conditions, limit, offset)
+
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
   NAME = 'puppet'
 
+  def __init__(self):
+    super(InventoryModule, self).__init__()
+    self._pdb = None
+
+  @property
+  def pdb(self):
+    '''
+    PuppetDB connection shared by every query of one inventory parse
+    '''
+    if self._pdb is None:
+      self._pdb = connect_pdb()
+    return self._pdb
+
   def parse(self, inventory, loader, path, cache=True):
     self.loader = loader
     self.inventory = inventory
-
-    self.display.vvv("FABRIC_PDB_CA: " + str(hashlib.sha256(open(os.environ['FABRIC_PDB_CA']).read().encode('utf-8')).hexdigest()))
-    self.display.vvv("FABRIC_PDB_SSL_CERT: " + str(hashlib.sha256(open(os.environ['FABRIC_PDB_SSL_CERT']).read().encode('utf-8')).hexdigest()))
-    self.display.vvv("FABRIC_PDB_SSL_KEY: " + str(hashlib.sha256(open(os.environ['FABRIC_PDB_SSL_KEY']).read().encode('utf-8')).hexdigest()))
+    self._pdb = None
 
     try: # the default ansible parser for yaml file values
       super(InventoryModule, self).parse(inventory, loader, path, cache)
@@ -82,14 +151,33 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     except Exception: # we're passing values with input string
       params = lib.parse_path(self.NAME, path)
 
+    self._log_ssl_digests()
     self.display.vvv('{}'.format(params))
-    results = self._get_results_from_api(params)
-    for host in results:
-      groups = lib.parsehost(host)
-      host = lib.get_lan_hostname(host)
-      for g in groups:
-        self.inventory.add_group(g)
-        self.inventory.add_host(host,group=g)
+    self.populate(self._get_results_from_api(params))
+
+  def populate(self, certnames):
+    '''
+    add the certnames to the inventory under their lan hostname, grouped by their certname,
+    resolving all of them in one batch
+    '''
+    lib.populate(self.inventory, lib.group_hosts(lib.get_lan_hostnames(certnames)))
+
+  def _log_ssl_digests(self):
+    '''
+    log the digests of the PuppetDB ssl files, only when -vvv asks for them
+    '''
+    if self.display.verbosity < 3:
+      return
+    for var in ('FABRIC_PDB_CA', 'FABRIC_PDB_SSL_CERT', 'FABRIC_PDB_SSL_KEY'):
+      ssl_file = os.getenv(var)
+      if not ssl_file:
+        continue
+      try:
+        with open(ssl_file, 'rb') as f:
+          digest = hashlib.sha256(f.read()).hexdigest()
+      except (IOError, OSError) as e:
+        digest = 'unreadable ({})'.format(e)
+      self.display.vvv('{}: {}'.format(var, digest))
 
   def verify_file(self, path):
     # if it starts with puppet:
@@ -107,26 +195,118 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
   def _get_results_from_api(self, params):
     self.display.vvv('getting results from api {0.filename}@{0.lineno}:'.format(inspect.getframeinfo(inspect.currentframe())))
     self.display.vvv('checking type')
-    if 'regex' in params:
+
+    # the selectors of an entry are combined by its own match, the entries of queries by
+    # the top level one. Without queries the top level params are the only entry
+    if params.get('queries'):
+      match = self._match(params, 'any')
+      entries = [(self._match(query, 'all'), self._queries(query)) for query in params['queries']]
+    else:
+      match = 'all'
+      entries = [(self._match(params, 'all'), self._queries(params))]
+    entries = [(entry_match, entry) for entry_match, entry in entries if entry]
+    queries = [query for entry_match, entry in entries for query in entry]
+    if not queries:
+      return []
+
+    if len(queries) == 1:
+      results = [queries[0]()]
+    else:
+      # connect before the queries share the connection
+      if self._pdb is None:
+        self._pdb = connect_pdb()
+      with ThreadPoolExecutor(max_workers=min(len(queries), PDB_QUERY_WORKERS)) as pool:
+        results = list(pool.map(lambda query: query(), queries))
+
+    matches = []
+    for entry_match, entry in entries:
+      entry_results, results = results[:len(entry)], results[len(entry):]
+      matches.append(self._combine(entry_match, entry_results))
+
+    self.display.vvv('combining {} queries with match={}'.format(len(matches), match))
+    return self._combine(match, matches)
+
+  @staticmethod
+  def _match(params, default):
+    match = params.get('match', default)
+    if match not in ('any', 'all'):
+      raise AnsibleError('puppet match must be any or all, not {}'.format(match))
+    return match
+
+  @classmethod
+  def _combine(cls, match, results):
+    '''
+    union (any) or intersection (all) of the results, each host once in the order
+    it was first returned in
+    '''
+    if match == 'all':
+      return cls._intersect(results)
+    seen = set()
+    return [host for result in results for host in result if not (host in seen or seen.add(host))]
+
+  @staticmethod
+  def _intersect(results):
+    '''
+    hosts of the first result that are in every other result, in their first order
+    '''
+    common_hosts = set(results[0]).intersection(*results[1:])
+    return [host for host in results[0] if host in common_hosts]
+
+  def _queries(self, params):
+    '''
+    one callable per selector in params, selectors may be lists of values and a host must match all of them
+    '''
+    def values(key):
+      value = params.get(key)
+      if value is None:
+        return []
+      return value if isinstance(value, list) else [value]
+
+    queries = []
+    for regex in values('regex'):
       self.display.vvv("looking for hosts_with_regex")
-      return self.hosts_regex(regex=params['regex'])
-    elif 'class' in params:
+      queries.append(lambda regex=regex: self.hosts_regex(regex=regex))
+    for classname in values('class'):
       self.display.vvv('looking for hosts_with_class')
-      return self.hosts_with_class(classname=params['class'])
-    elif 'fact' in params and 'value' in params:
+      queries.append(lambda classname=classname: self.hosts_with_class(classname=classname))
+    facts, fact_values = values('fact'), values('value')
+    if len(facts) != len(fact_values):
+      raise AnsibleError('puppet fact and value must be given in pairs, got {} facts and {} values'.format(len(facts), len(fact_values)))
+    if facts:
       self.display.vvv('looking for hosts_with_fact')
-      return self.hosts_with_fact(fact_name=params['fact'], fact_value=params['value'])
-    elif 'resource' in params:
+      for fact_name, fact_value in zip(facts, fact_values):
+        queries.append(lambda fact_name=fact_name, fact_value=fact_value: self.hosts_with_fact(fact_name=fact_name, fact_value=fact_value))
+    for resource in values('resource'):
       self.display.vvv('looking for hosts_with_resource')
-      return self.hosts_with_resource(resource=params['resource'])
-    else:
-      return []
+      queries.append(lambda resource=resource: self.hosts_with_resource(resource=resource))
+    return queries
+
+  def certnames(self, entity, conditions):
+    '''
+    run a PQL query projecting only certname, one page of PDB_PAGE_SIZE at a time,
+    and yield each certname once as the pages arrive. Grouping by certname gives one
+    row per host, so the pages of resources and facts do not shift between requests
+    '''
+    seen = set()
+    offset = 0
+    while True:
+      query = pql_certnames(entity, conditions, PDB_PAGE_SIZE, offset)
+      self.display.vvv('pql: {}'.format(query))
+      count = 0
+      for row in self.pdb.pql(query):
+        count += 1
+        certname = row['certname'] if isinstance(row, dict) else getattr(row, 'name', None) or row.node
+        if certname not in seen:
+          seen.add(certname)
+          yield certname
+      if count < PDB_PAGE_SIZE:
+        return
+      offset += PDB_PAGE_SIZE
 
   def hosts_with_class(self, classname):
     '''
     get all hosts including a class
     '''
-    pdb = connect_pdb()
     class_parts = classname.split('::')
     self.display.vvv('Class Parts: {}'.format(class_parts))
     class_parts = [x.capitalize() for x in class_parts]
@@ -135,9 +315,8 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     classname = "::".join(class_parts)
     self.display.vvv('classname: {}'.format(classname))
 
-    nodes = pdb.resources('Class', classname)
-    # print nodes
-    return [lib.get_lan_hostname(node.node) for node in nodes]
+    nodes = self.certnames('resources', 'type = "Class" and title = {}'.format(pql_string(classname)))
+    return list(nodes)
 
 
   def hosts_with_resource(self, resource, name=None):
@@ -145,21 +324,22 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
       get all hosts with a resource defined
       if name is set, will only get hosts with Resource['name']
       '''
-      pdb = connect_pdb()
-      nodes = pdb.resources(resource, name)
-      # print name
-      # print resource
-      return [lib.get_lan_hostname(node.node) for node in nodes]
+      conditions = 'type = {}'.format(pql_string(resource))
+      if name is not None:
+        conditions += ' and title = {}'.format(pql_string(name))
+      nodes = self.certnames('resources', conditions)
+      return list(nodes)
 
 
   def hosts_with_fact(self, fact_name, fact_value, operator='='):
       '''
       get all hosts where fact_name == fact_value
       '''
-      pdb = connect_pdb()
       self.display.vvv("searching for fact {} with value {}".format(fact_name, fact_value))
-      nodes = pdb.facts(fact_name, fact_value)
-      return [lib.get_lan_hostname(node.node) for node in nodes]
+      if operator not in PQL_OPERATORS:
+        raise AnsibleError('unsupported fact operator {}'.format(operator))
+      nodes = self.certnames('facts', 'name = {} and {}'.format(pql_string(fact_name), pql_value(operator, fact_value)))
+      return list(nodes)
 
 
   def hosts_regex(self, regex=".*"):
@@ -167,16 +347,112 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
       get all hosts where the hostname matches a given regex
       (default matches everything)
       '''
-      pdb = connect_pdb()
-      nodes = pdb.nodes()
-      return [lib.get_lan_hostname(node.name) for node in nodes if re.match(regex, node.name)]
+      # PuppetDB regexes are unanchored, re.match used to anchor them at the start
+      if not regex.startswith('^'):
+        regex = '^' + regex
+      nodes = self.certnames('nodes', 'certname ~ {}'.format(pql_string(regex)))
+      return list(nodes)
 
 if __name__ == '__main__':
-    inventory = {}
-    enterprise = {}
-
-    # return to ansible
-    sys.stdout.write(str(inventory))
+    # checks of the PQL queries, then a benchmark of the per-host parse cost against a
+    # synthetic PuppetDB and DNS: python puppet.py [nodes] [dns latency in ms]
+    import time
+    from ansible.inventory.data import InventoryData
+
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0002
+    certnames = ['web{}.prod{}.site{}.example.com'.format(i, i % 50, i % 5) for i in range(nodes)]
+
+    class FakePuppetDB(object):
+      def pql(self, query):
+        limit, offset = [int(x) for x in re.search(r'limit (\d+) offset (\d+)', query).groups()]
+        return [{'certname': c} for c in certnames[offset:offset + limit]]
+
+      def nodes(self):
+        return [type('Node', (object,), {'name': c}) for c in certnames]
+
+    assert pql_string('a "b" \\c') == '"a \\"b\\" \\\\c"'
+    assert pql_value('=', 'physical') == 'value = "physical"'
+    assert pql_value('=', True) == 'value = true'
+    assert pql_value('>=', 8) == 'value >= 8'
+    assert pql_value('=', '8') == '(value = "8" or value = 8)'
+    assert pql_value('!=', 'false') == '!(value = "false" or value = false)'
+    assert pql_value('<', '2.5') == 'value < 2.5'
+    assert pql_value('~', '^1') == 'value ~ "^1"'
+    assert pql_certnames('nodes', 'certname ~ "^a"', 10, 20) == \
+      'nodes[certname] { certname ~ "^a" group by certname order by certname limit 10 offset 20 }'
+
+    class RecordingPuppetDB(object):
+      def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+      def pql(self, query):
+        self.queries.append(query)
+        limit, offset = [int(x) for x in re.search(r'limit (\d+) offset (\d+)', query).groups()]
+        return [{'certname': c} for c in self.rows[offset:offset + limit]]
+
+    plugin = InventoryModule()
+    plugin._pdb = RecordingPuppetDB(['a', 'b', 'c', 'd', 'e'])
+    page_size, PDB_PAGE_SIZE = PDB_PAGE_SIZE, 2
+    assert plugin.hosts_with_class('roles::web::app') == ['a', 'b', 'c', 'd', 'e']
+    assert plugin._pdb.queries == [pql_certnames('resources', 'type = "Class" and title = "Roles::Web::App"', 2, offset)
+                                   for offset in (0, 2, 4)], plugin._pdb.queries
+    PDB_PAGE_SIZE = page_size
+
+    plugin._pdb.queries = []
+    plugin.hosts_regex('web')
+    plugin.hosts_with_fact('virtual', 'physical')
+    plugin.hosts_with_resource('User', 'bob')
+    assert [q.split(' group by')[0] for q in plugin._pdb.queries] == [
+      'nodes[certname] { certname ~ "^web"',
+      'facts[certname] { name = "virtual" and value = "physical"',
+      'resources[certname] { type = "User" and title = "bob"'], plugin._pdb.queries
+    for bad in ({'fact': ['virtual', 'is_pe'], 'value': 'physical'}, {'value': 'physical'}, {'class': 'x', 'match': 'some'}):
+      try:
+        plugin._get_results_from_api(bad)
+        raise AssertionError('{} was accepted'.format(bad))
+      except AnsibleError:
+        pass
+
+    def gethostbyname(name):
+      time.sleep(latency)
+      if name.startswith('lan.'):
+        return '10.0.0.1'
+      return '192.0.2.1'
+
+    def legacy_get_lan_hostname(hostname):
+      # serial probing as done before the shared resolver
+      for name in lib.LanResolver.candidates(hostname):
+        try:
+          if lib.LAN_NETWORK.match(socket.gethostbyname(name)):
+            return name
+        except socket.gaierror:
+          pass
+      return hostname
+
+    def legacy_parse(inventory):
+      # hosts_regex resolved every node, then parse resolved the result again
+      pdb = FakePuppetDB()
+      results = [legacy_get_lan_hostname(node.name) for node in pdb.nodes() if re.match('.*', node.name)]
+      for host in results:
+        groups = lib.parsehost(host)
+        host = legacy_get_lan_hostname(host)
+        for g in groups:
+          inventory.add_group(g)
+          inventory.add_host(host, group=g)
+
+    def current_parse(inventory):
+      lib._lan_resolver = lib.LanResolver(cache_path=None)
+      plugin = InventoryModule()
+      plugin.inventory = inventory
+      plugin._pdb = FakePuppetDB()
+      plugin.populate(plugin._get_results_from_api({'regex': '.*'}))
+
+    socket.gethostbyname = gethostbyname
+    for name, run in (('before', legacy_parse), ('after', current_parse)):
+      start = time.time()
+      run(InventoryData())
+      elapsed = time.time() - start
+      sys.stdout.write('{:<6} {} nodes in {:.2f}s, {:.1f}us per host\n'.format(name, nodes, elapsed, elapsed / nodes * 1e6))
     sys.stdout.flush()
-
-
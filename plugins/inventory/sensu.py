@@ -7,6 +7,8 @@ display = Display()
 import os
 import sys
 import re
+import time
+import operator as op
 import requests
 
 # add . to search path so we can find our common lib stuff
@@ -23,13 +25,24 @@ DOCUMENTATION = r'''
         - This plugin only applies to inventory strings that are not paths and begin with the module's name.
         - Possible parameters are `check`, `event`, `state`, and `operator`.
         - check and `event` are both the names of checks defined in sensu, but the events api returns MUCH faster than the checks api, so check should only be used in cases where there's not an event (e.g. the check isn't failing).
-        - state is the expected state of the check to operate on (OK, WARN, FAIL, UNKNOWN, etc).
-        - operator is the operation to perform `<`, `>`, `=`, etc.
+        - state is the expected state of the check to operate on (OK, WARN, FAIL, UNKNOWN, etc), or an inclusive range such as `WARNING..CRITICAL`.
+        - operator is the operation to perform `<`, `<=`, `>`, `>=`, `=`, `!=`.
+        - check and event accept several check names separated by `|`, a host matches if any of them matches.
+        - subscription limits the hosts to clients with one of the given subscriptions (separated by `|`).
+        - max_age serves api answers from the local snapshot when they are at most that many seconds old (default SENSU_MAX_AGE or 0).
+        - When the api cannot be reached the last snapshot is used if it is at most max_stale seconds old (default SENSU_MAX_STALE or 3600), otherwise the inventory fails.
+        - Check results in the snapshot are refreshed from the fast events api, a full results download only happens every SENSU_FULL_REFRESH seconds.
 '''
 
 EXAMPLES = r'''
 To restart the puppet agent on all machines with a failing puppet run
 # ansible-playbook -i 'sensu:check=CORE_puprun,operator=>,state=OK' ~/Code/stash.example.com/ANSB/role-puppet/tasks/restart-agent.yml
+
+All webservers with a warning or critical disk or load check
+# ansible-playbook -i 'sensu:event=CORE_disk|CORE_load,state=WARNING..CRITICAL,subscription=webserver' ...
+
+Hosts with a failing puppet run, as seen by sensu within the last 10 minutes
+# ansible-playbook -i 'sensu:check=CORE_puprun,operator=>,state=OK,max_age=600' ...
 '''
 
 SENSU_API = 'sensu-aws.example.com:4567'
@@ -37,9 +50,94 @@ EVENTS_API = "http://{}/events".format(SENSU_API)
 RESULTS_API = "http://{}/results".format(SENSU_API)
 CLIENTS_API = "http://{}/clients".format(SENSU_API)
 
+# bytes read from the api per chunk while streaming large responses
+STREAM_CHUNK_SIZE = 256 * 1024
+# seconds to wait for the slow results and clients apis
+SENSU_TIMEOUT = int(os.getenv('SENSU_TIMEOUT', 30))
+
+# local snapshot of api answers, see max_age in DOCUMENTATION
+SENSU_SNAPSHOT = os.path.expanduser(os.getenv('SENSU_SNAPSHOT', '~/.ansible/tmp/sensu_snapshot.json'))
+SENSU_MAX_AGE = int(os.getenv('SENSU_MAX_AGE', 0))
+SENSU_FULL_REFRESH = int(os.getenv('SENSU_FULL_REFRESH', 3600))
+# oldest snapshot served when the api fails, targets older than this are not trusted
+SENSU_MAX_STALE = int(os.getenv('SENSU_MAX_STALE', 3600))
+
 SENSU_OK = 0
 SENSU_WARNING = 1
 SENSU_ERROR = 2
+SENSU_UNKNOWN = 3
+
+OPERATORS = {
+  '=': op.eq,
+  '==': op.eq,
+  '!=': op.ne,
+  '<': op.lt,
+  '<=': op.le,
+  '>': op.gt,
+  '>=': op.ge,
+}
+
+STATES = [
+  (re.compile('^WARN(ING)?'), SENSU_WARNING),
+  (re.compile('^(ERR(OR)?|CRIT(ICAL)?)'), SENSU_ERROR),
+  (re.compile('^UNKNOWN'), SENSU_UNKNOWN),
+  (re.compile('^OK'), SENSU_OK),
+]
+
+def state_value(state):
+  ''' sensu status code for a state name (or number), unknown names count as OK '''
+  state = state.strip().upper()
+  if state.isdigit():
+    return int(state)
+  for pattern, value in STATES:
+    if pattern.search(state):
+      return value
+  return SENSU_OK
+
+def split_values(value):
+  ''' turn 'a|b' or ['a', 'b'] into a list, None stays None '''
+  if value is None:
+    return None
+  if not isinstance(value, list):
+    value = str(value).split('|')
+  return [v for v in value if v != ''] or None
+
+def compile_predicate(checks=None, state=None, operator='=', subscriptions=None):
+  '''
+  build a callable(check, status, subscriptions) -> bool from the inventory parameters,
+  parsing them once instead of for every event
+
+  checks and subscriptions are lists, any of them may match. state is a state name,
+  a status code or an inclusive `LOW..HIGH` range, an empty state matches any status.
+  '''
+  tests = []
+
+  if checks:
+    check_set = frozenset(checks)
+    tests.append(lambda check, status, subs: check in check_set)
+
+  if state:
+    if '..' in state:
+      low, high = [state_value(s) for s in state.split('..', 1)]
+      tests.append(lambda check, status, subs: low <= status <= high)
+    else:
+      if operator not in OPERATORS:
+        raise AnsibleError('unsupported sensu operator {}, expected one of {}'.format(operator, ' '.join(sorted(OPERATORS))))
+      compare = OPERATORS[operator]
+      state_val = state_value(state)
+      tests.append(lambda check, status, subs: compare(status, state_val))
+
+  if subscriptions:
+    subscription_set = frozenset(subscriptions)
+    tests.append(lambda check, status, subs: subs is not None and not subscription_set.isdisjoint(subs))
+
+  def predicate(check, status, subs=None):
+    for test in tests:
+      if not test(check, status, subs):
+        return False
+    return True
+
+  return predicate
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
@@ -47,6 +145,11 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
   def __init__(self):
     self.check = None
+    self.matched_checks = {}
+    self.snapshot = {}
+    self.snapshot_dirty = False
+    self.max_age = SENSU_MAX_AGE
+    self.max_stale = SENSU_MAX_STALE
     super(InventoryModule, self).__init__()
 
   def verify_file(self, path):
@@ -74,17 +177,22 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     except Exception: # we're passing values with input string
       params = lib.parse_path(self.NAME, path)
 
+    self.max_age = int(params.get('max_age', SENSU_MAX_AGE))
+    self.max_stale = int(params.get('max_stale', SENSU_MAX_STALE))
+    self.snapshot = lib.load_json_cache(SENSU_SNAPSHOT)
     results = self._get_results_from_api(params)
+    if self.snapshot_dirty:
+      lib.save_json_cache(SENSU_SNAPSHOT, self.snapshot)
+
+    # hosts are grouped by their sensu name and added under their lan name,
+    # the check groups hold the sensu names
+    graph = lib.group_hosts(lib.get_lan_hostnames(results))
     for host in results:
-      if self.check != None:
-        self.inventory.add_group(self.check)
-        self.inventory.add_host(host, group=self.check)
-      groups = lib.parsehost(host)
-      host = lib.get_lan_hostname(host)
-      self.display.vvvv("adding host: {}".format(host))
-      for g in groups:
-        self.inventory.add_group(g)
-        self.inventory.add_host(host,group=g)
+      for check in self.matched_checks.get(host, ()):
+        graph.setdefault(check, set()).add(host)
+
+    self.display.vvvv("adding hosts: {}".format(graph))
+    lib.populate(self.inventory, graph)
 
   def _get_results_from_api(self, params):
     if 'check' in params:
@@ -111,17 +219,80 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
       operator = '='
     self.display.vvvv('operator: {}'.format(operator))
 
+    subscriptions = split_values(params.get('subscription'))
+    self.display.vvvv('subscriptions: {}'.format(subscriptions))
+
     self.display.vvv('checking type')
     self.check = check
     if 'event' in params:
       self.display.vvv("looking for hosts_with_event")
-      return self.hosts_with_event(check=check, state=state, operator=operator)
+      return self.hosts_with_event(check=check, state=state, operator=operator, subscriptions=subscriptions)
     elif 'check' in params:
       self.display.vvv('looking for hosts_with_check')
-      return self.hosts_with_check(check=check, state=state, operator=operator)
+      return self.hosts_with_check(check=check, state=state, operator=operator, subscriptions=subscriptions)
     else:
-      return self.all_sensu_clients()
-
+      return self.all_sensu_clients(subscriptions=subscriptions)
+
+  def _check_url(self, api, checks):
+    # the api can only filter on a single check name, several checks are filtered locally
+    if len(checks) == 1:
+      return "{}?filter.check.name={}".format(api, checks[0])
+    return api
+
+  def _collect(self, records, predicate):
+    '''
+    single pass over [client, check, status, subscriptions, ...] records,
+    returning the matching clients and remembering which checks matched them
+    '''
+    ret = []
+    for record in records:
+      client, check, status, subs = record[:4]
+      self.display.vvvvvv("Host {} -- Check: {} -- State: {}".format(client, check, status))
+      if predicate(check, status, subs):
+        self.display.vvvvvv("adding {} to host list".format(client))
+        if client not in self.matched_checks:
+          ret.append(client)
+        self.matched_checks.setdefault(client, set()).add(check)
+    return ret
+
+  def _snapshot(self, name, fetch):
+    '''
+    return the records stored under name in the snapshot when younger than max_age,
+    otherwise fetch(entry) -> (records, extra) and store them. If the api fails
+    the snapshot is served when it is at most max_stale seconds old.
+    '''
+    entry = self.snapshot.get(name)
+    now = time.time()
+    if entry and now - entry['fetched_at'] <= self.max_age:
+      self.display.vvv('using sensu snapshot of {} from {:.0f}s ago'.format(name, now - entry['fetched_at']))
+      return entry['records']
+
+    try:
+      records, extra = fetch(entry)
+    except (requests.exceptions.RequestException, ValueError) as e:
+      if not entry:
+        raise AnsibleError('sensu api request for {} failed: {}'.format(name, e))
+      if now - entry['fetched_at'] > self.max_stale:
+        raise AnsibleError('sensu api request for {} failed: {}, the snapshot from {:.0f}s ago is older than max_stale ({}s)'.format(name, e, now - entry['fetched_at'], self.max_stale))
+      self.display.warning('sensu api request for {} failed ({}), using snapshot from {:.0f}s ago'.format(name, e, now - entry['fetched_at']))
+      return entry['records']
+
+    entry = dict(extra, fetched_at=now, records=records)
+    self.snapshot[name] = entry
+    self.snapshot_dirty = True
+    return records
+
+  def _stream(self, url, timeout=SENSU_TIMEOUT):
+    '''
+    yield the items of the json array at url while it downloads
+    '''
+    r = requests.get( url, stream=True, timeout=timeout )  # , verify=False)
+    try:
+      r.raise_for_status()
+      for item in lib.iter_json_array(r.iter_content(STREAM_CHUNK_SIZE)):
+        yield item
+    finally:
+      r.close()
 
   '''
   hosts_with_event and hosts_with_check will return similar data with drastic differences in the amount of time it takes them to run
@@ -136,88 +307,198 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
   '''
 
 
-  def hosts_with_event(self, check='', state='ERROR', operator='='):
+  def hosts_with_event(self, check='', state='ERROR', operator='=', subscriptions=None):
       '''
       Get a list of hosts with a specific check on them in a non-OK state, optionally in a specific given state
 
       example:
         TBD
       '''
-      if operator == '=':
-        operator = '=='
-
+      checks = split_values(check) or ['']
+      predicate = compile_predicate(checks, state or 'OK', operator, subscriptions)
 
       self.display.vvv('in hosts_with_event')
       self.display.vvvv('check={}, state={}, operator={}'.format(check, state, operator))
 
-      state_val = SENSU_OK
-      if state:
-          if re.search('^WARN(ING)?', state):
-              state_val = SENSU_WARNING
-          elif re.search('^(ERR(OR)?|CRIT(ICAL)?)', state):
-              state_val = SENSU_ERROR
-
-      url = "{}?filter.check.name={}".format(EVENTS_API, check)
-      self.display.vvv("state_val: {}".format(state_val))
+      url = self._check_url(EVENTS_API, checks)
       self.display.vvv('about to hit api call ({})'.format(url))
 
-      try:
-        r = requests.get( url, timeout=5 )  # , verify=False
-      except TimeoutError:
-        self.display.error("web request timed out")
-        return {}
+      def fetch(entry):
+        return self._events(url), {}
 
-      self.display.vvv("response from api call: {}".format(r))
-
-      ret = []
-      for event in r.json():
-          self.display.vvvvvv("Host {} -- Check: {} -- State: {}".format(event['client']['name'], event['check']['name'], event['check']['status']))
-          if event['check']['name'] == check:
-            if eval("{} {} {}".format(event['check']['status'], operator, state_val)):
-              self.display.vvvvvv("adding {} to host list".format(event['client']['name']))
-              ret.append(event['client']['name'])
+      return self._collect(self._snapshot(url, fetch), predicate)
 
-      return ret
+  def _events(self, url=EVENTS_API):
+      '''
+      [client, check, status, subscriptions, executed] of every event at url
+      '''
+      r = requests.get( url, timeout=5 )  # , verify=False
+      r.raise_for_status()
+      self.display.vvv("response from api call: {}".format(r))
+      return [[event['client']['name'], event['check']['name'], event['check']['status'],
+               event['client'].get('subscriptions'), event['check'].get('executed', 0)]
+              for event in r.json()]
 
 
-  def hosts_with_check(self, check, state='ERROR', operator='='):
+  def hosts_with_check(self, check, state='ERROR', operator='=', subscriptions=None):
       '''
       Get a list of hosts with a specific check on them, optionally in a given state
       '''
-
-      if operator == '=':
-          operator = '=='
-
-      state_val = 0
-      if state:
-          if re.search('^WARN(ING)?', state):
-              state_val = SENSU_WARNING
-          elif re.search('^(ERR(OR)?|CRIT(ICAL)?)', state):
-              state_val = SENSU_ERROR
-          elif re.search('^OK', state):
-              state_val = SENSU_OK
-
+      checks = split_values(check) or ['']
+      predicate = compile_predicate(checks, state, operator)
+
+      # results only carry the client name, subscriptions come from the clients api
+      client_subscriptions = {}
+      if subscriptions:
+        client_subscriptions = dict((name, subs) for name, subs in self._clients())
+        predicate = compile_predicate(checks, state, operator, subscriptions)
+
+      url = self._check_url(RESULTS_API, checks)
+
+      def fetch(entry):
+        # patch the last full download from the events api until it is SENSU_FULL_REFRESH old
+        if entry and time.time() - entry.get('full_at', 0) <= SENSU_FULL_REFRESH:
+          return self._apply_events(entry['records'], checks), {'full_at': entry['full_at']}
+        # results carry the full check output of every client, only keep what we filter on
+        records = [[result['client'], result['check']['name'], result['check']['status'], None, result['check'].get('executed', 0)]
+                   for result in self._stream(url)]
+        return records, {'full_at': time.time()}
+
+      records = ((client, check, status, client_subscriptions.get(client), executed)
+                 for client, check, status, subs, executed in self._snapshot(url, fetch))
+      return self._collect(records, predicate)
+
+  def _apply_events(self, records, checks):
+      '''
+      bring snapshot results up to date from the events api: every non-OK result has an
+      event, so results without one have recovered and new events are new results
+      '''
+      events = dict(((e[0], e[1]), e) for e in self._events() if e[1] in checks or checks == [''])
       ret = []
-      url = "{}?filter.check.name={}".format(RESULTS_API, check)
-      r = requests.get( url )  # , verify=False)
-      for event in r.json():
-          if event['check']['name'] == check:
-              if state:
-                  if eval("{} {} {}".format(event['check']['status'], operator, state_val)):
-                      ret.append(event['client'])
-              else:
-                  ret.append(event['client'])
-
+      for client, check, status, subs, executed in records:
+        event = events.pop((client, check), None)
+        if event is not None:
+          if event[4] >= executed:
+            status, executed = event[2], event[4]
+        elif status != SENSU_OK:
+          status = SENSU_OK
+        ret.append([client, check, status, subs, executed])
+      for client, check, status, subs, executed in events.values():
+        ret.append([client, check, status, None, executed])
       return ret
 
-  def all_sensu_clients(self):
+  def _clients(self):
+      '''
+      [name, subscriptions] of every sensu client
+      '''
+      def fetch(entry):
+        return [[client['name'], client.get('subscriptions')] for client in self._stream(CLIENTS_API)], {}
+
+      return self._snapshot(CLIENTS_API, fetch)
+
+  def all_sensu_clients(self, subscriptions=None):
       '''
       Get a list of all sensu clients
       '''
+      predicate = compile_predicate(subscriptions=subscriptions)
 
       ret = []
-      r = requests.get( CLIENTS_API )  # , verify=False)
-      for client in r.json():
-        ret.append(client['name'])
+      for name, subs in self._clients():
+        if predicate(None, None, subs):
+          ret.append(name)
 
       return ret
+
+if __name__ == '__main__':
+    # self test of the predicates and the snapshot refresh against a fake sensu api:
+    # python sensu.py
+    import json
+
+    predicate = compile_predicate(['CORE_disk', 'CORE_load'], 'WARNING..CRITICAL', subscriptions=['web'])
+    assert predicate('CORE_disk', SENSU_WARNING, ['web', 'base'])
+    assert predicate('CORE_load', SENSU_ERROR, ['web'])
+    assert not predicate('CORE_disk', SENSU_OK, ['web'])
+    assert not predicate('CORE_disk', SENSU_UNKNOWN, ['web'])
+    assert not predicate('CORE_puprun', SENSU_ERROR, ['web'])
+    assert not predicate('CORE_disk', SENSU_ERROR, ['db'])
+    assert not predicate('CORE_disk', SENSU_ERROR, None)
+    assert compile_predicate(['CORE_puprun'], 'OK', '>')('CORE_puprun', SENSU_ERROR)
+    assert not compile_predicate(['CORE_puprun'], 'OK', '>')('CORE_puprun', SENSU_OK)
+    assert compile_predicate(state='')('anything', SENSU_UNKNOWN)
+    assert state_value('crit') == SENSU_ERROR and state_value('2') == SENSU_ERROR and state_value('bogus') == SENSU_OK
+
+    results = [{'client': 'web1', 'check': {'name': 'CORE_puprun', 'status': 0, 'executed': 100}},
+               {'client': 'web2', 'check': {'name': 'CORE_puprun', 'status': 2, 'executed': 100}}]
+    events = [{'client': {'name': 'web1', 'subscriptions': ['web']}, 'check': {'name': 'CORE_puprun', 'status': 2, 'executed': 200}}]
+    requested = []
+
+    class FakeResponse(object):
+      def __init__(self, data):
+        self.data = data
+
+      def raise_for_status(self):
+        pass
+
+      def json(self):
+        return self.data
+
+      def iter_content(self, size):
+        return [json.dumps(self.data).encode('utf-8')]
+
+      def close(self):
+        pass
+
+    def fake_get(url, **kwargs):
+      requested.append(url.split('?')[0])
+      if url.startswith(EVENTS_API):
+        return FakeResponse(events)
+      return FakeResponse(results)
+
+    requests.get = fake_get
+    plugin = InventoryModule()
+    url = plugin._check_url(RESULTS_API, ['CORE_puprun'])
+
+    # the first refresh downloads every result
+    assert plugin.hosts_with_check('CORE_puprun', state='OK', operator='>') == ['web2']
+    assert requested == [RESULTS_API], requested
+
+    # an expired snapshot is patched from the events api only: web2 has no event so
+    # it recovered, web1 failed since
+    plugin.snapshot[url]['fetched_at'] -= 10
+    del requested[:]
+    plugin.matched_checks = {}
+    assert plugin.hosts_with_check('CORE_puprun', state='OK', operator='>') == ['web1']
+    assert requested == [EVENTS_API], requested
+
+    # a snapshot younger than max_age is served without any request
+    plugin.max_age = 60
+    del requested[:]
+    plugin.matched_checks = {}
+    assert plugin.hosts_with_check('CORE_puprun', state='OK', operator='>') == ['web1']
+    assert requested == []
+
+    # after SENSU_FULL_REFRESH the results are downloaded again
+    plugin.max_age = 0
+    plugin.snapshot[url]['fetched_at'] -= SENSU_FULL_REFRESH + 10
+    plugin.snapshot[url]['full_at'] -= SENSU_FULL_REFRESH + 10
+    del requested[:]
+    plugin.matched_checks = {}
+    assert plugin.hosts_with_check('CORE_puprun', state='OK', operator='>') == ['web2']
+    assert requested == [RESULTS_API], requested
+
+    # when the api fails a snapshot is only served up to max_stale seconds old
+    def failing_get(url, **kwargs):
+      raise requests.exceptions.ConnectionError('sensu is down')
+
+    requests.get = failing_get
+    plugin.snapshot[url]['fetched_at'] -= 10
+    plugin.matched_checks = {}
+    assert plugin.hosts_with_check('CORE_puprun', state='OK', operator='>') == ['web2']
+    plugin.snapshot[url]['fetched_at'] -= plugin.max_stale
+    try:
+      plugin.hosts_with_check('CORE_puprun', state='OK', operator='>')
+      raise AssertionError('a snapshot older than max_stale was served')
+    except AnsibleError:
+      pass
+
+    sys.stdout.write('sensu self test passed\n')
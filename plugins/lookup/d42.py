@@ -1,6 +1,10 @@
 from ansible.errors import AnsibleError
 from ansible.plugins.lookup import LookupBase
-import json, requests, imp, sys, csv, io, os
+from ansible.module_utils._text import to_bytes
+from ansible.parsing.vault import VaultLib, VaultSecret
+import json, requests, imp, sys, csv, io, os, re, tempfile, threading, time, contextlib, fcntl
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 if 'D42_SKIP_SSL_CHECK' in os.environ and os.environ['D42_SKIP_SSL_CHECK'] == 'True':
     requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
@@ -19,21 +23,158 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+# add . to search path so we can find the shared d42 session code
+sys.path.append(os.path.dirname(__file__))
+from d42_common import D42_WORKERS, get_session
 
-class LookupModule(LookupBase):
+# device names per DOQL query of batch d42info lookups
+D42_BATCH_SIZE = int(os.getenv('D42_BATCH_SIZE', 500))
+# records per page of the password api
+D42_PAGE_SIZE = int(os.getenv('D42_PAGE_SIZE', 1000))
 
-    @staticmethod
-    def get_list_from_csv(text):
-        f = io.StringIO(text.decode("utf-8"))
-        output_list = []
-        dict_reader = csv.DictReader(f, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True, dialect='excel')
-        for item in dict_reader:
-            output_list.append(item)
+def _doql_int(value):
+    return int(value) if value else None
+
+# /devices/id/ fields batch d42info can read from DOQL: (view_device_v1 column, csv value -> api value)
+D42_BATCH_INFO = {
+    'device_id': ('device_pk', _doql_int),
+    'name': ('name', str),
+    'serial_no': ('serial_no', str),
+    'asset_no': ('asset_no', str),
+    'uuid': ('uuid', str),
+    'type': ('type', str),
+    'service_level': ('service_level', str),
+    'notes': ('notes', str),
+}
+
+# memoization of password and device info lookups
+D42_CACHE_SIZE = int(os.getenv('D42_CACHE_SIZE', 1024))
+D42_CACHE_TTL = int(os.getenv('D42_CACHE_TTL', 300))
+# on-disk store, disabled unless a path is given. Ansible runs the lookups of every
+# host in a forked worker, so results are only shared between hosts through this file.
+# Passwords are only written to it when D42_CACHE_KEY is set, in which case the whole
+# file is vault encrypted
+D42_CACHE_PATH = os.getenv('D42_CACHE_PATH')
+D42_CACHE_KEY = os.getenv('D42_CACHE_KEY')
+
+
+class LookupCache(object):
+    """
+    LRU of lookup results with a TTL. Without a path it only lives as long as the
+    worker process, i.e. one host's task; with a path the entries are shared through
+    a file that every write re-reads and merges under a lock. Entries flagged secret
+    never reach the disk in plaintext.
+    """
+
+    def __init__(self, size=D42_CACHE_SIZE, ttl=D42_CACHE_TTL, path=D42_CACHE_PATH, key=D42_CACHE_KEY):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.vault = None
+        if key:
+            self.vault = VaultLib([('default', VaultSecret(to_bytes(key)))])
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive):
+        # serializes the forks that share self.path, a no-op without it
+        if not self.path:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        """ unexpired entries of the file, {} when there is none """
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            if self.vault is not None:
+                data = self.vault.decrypt(data)
+            entries = json.loads(data.decode('utf-8'))
+        except Exception as e:
+            display.warning("Ignoring unreadable d42 lookup cache %s: %s" % (self.path, e))
+            return {}
+        now = time.time()
+        return dict((k, v) for k, v in entries.items() if v[1] >= now)
+
+    def _merge(self, entries):
+        # keep whichever copy of a key expires last
+        for key, entry in entries.items():
+            mine = self._entries.get(key)
+            if mine is None or mine[1] < entry[1]:
+                self._entries[key] = entry
+
+    def _evict(self):
+        # least recently used first, callers move the key they use to the end beforehand
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _write(self):
+        entries = dict((k, v) for k, v in self._entries.items() if self.vault is not None or not v[2])
+        data = to_bytes(json.dumps(entries))
+        if self.vault is not None:
+            data = self.vault.encrypt(data)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            display.warning("Could not write d42 lookup cache %s: %s" % (self.path, e))
 
-        if len(output_list) == 1:
-            output_list = [output_list,]
+    def get(self, key):
+        """ return (hit, value) """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.path:
+                # another fork may have stored it since
+                with self._file_lock(False):
+                    self._merge(self._read())
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self._evict()
+                entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] < time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
 
-        return output_list
+    def set(self, key, value, secret=False):
+        with self._lock:
+            self._entries[key] = [value, time.time() + self.ttl, secret]
+            self._entries.move_to_end(key)
+            if not self.path or (secret and self.vault is None):
+                self._evict()
+                return
+            with self._file_lock(True):
+                self._merge(self._read())
+                self._entries.move_to_end(key)
+                self._evict()
+                self._write()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            if self.path:
+                with self._file_lock(True):
+                    self._write()
+
+_cache = LookupCache()
+
+
+class LookupModule(LookupBase):
 
     def run(self, terms, variables=None, **kwargs):
         conf = {
@@ -41,21 +182,54 @@ class LookupModule(LookupBase):
             'D42_USER': os.environ['D42_USERNAME'],
             'D42_PWD': os.environ['D42_PASSWORD']
         }
+        if len(terms) < 2:
+            if terms and terms[0] == "cache":
+                raise AnsibleError("d42 cache lookups need an action, e.g. lookup('d42', 'cache', 'flush')")
+            raise AnsibleError("d42 lookups need at least two terms, e.g. lookup('d42', device, 'password', username)")
+        # explicit invalidation: lookup('d42', 'cache', 'flush')
+        if terms[0] == "cache":
+            if terms[1] != "flush":
+                raise AnsibleError("Unknown d42 cache action %s, only 'flush' is supported" % terms[1])
+            _cache.invalidate()
+            return [True]
+
+        if terms[0] == "servicePassword" or terms[1] in ("password", "d42info"):
+            key = json.dumps([conf['D42_URL'], conf['D42_USER']] + list(terms))
+            if not kwargs.get('refresh'):
+                hit, value = _cache.get(key)
+                if hit:
+                    return value
+            value = self.dispatch(conf, terms, **kwargs)
+            _cache.set(key, value, secret=terms[1] != "d42info")
+            return value
+
+        return self.dispatch(conf, terms, **kwargs)
+
+    def dispatch(self, conf, terms, **kwargs):
+        # batch mode, the first term is a list of devices or of [device, username] pairs
+        if isinstance(terms[0], list):
+            if terms[1] == "password":
+                username = terms[2] if len(terms) > 2 else None
+                return self.getUserPasses(conf, terms[0], username)
+            elif terms[1] == "d42info":
+                return self.devicesInfo(conf, terms[0], terms[2])
+            raise AnsibleError("Batch lookups only support 'password' and 'd42info'")
+
         if terms[1] == "password":
             return self.getUserPass(conf, terms[0], terms[2])
         elif terms[0] == "servicePassword":
             return self.getServicePass(conf, terms[1], terms[2], terms[3])
         elif terms[1] == "doql":
-            return self.runDoql(conf, terms[0],  terms[2])
+            dest = terms[3] if len(terms) > 3 else None
+            return self.runDoql(conf, terms[0],  terms[2], dest, kwargs.get('page_size'), kwargs.get('order_by'))
         elif terms[1] == "d42info":
             return self.deviceInfo(conf, terms[0], terms[2])
 
     def getUserPass(self, conf, device, username):
         url = conf['D42_URL'] + "/api/1.0/passwords/?plain_text=yes&device=" + device + "&username=" + username
-        resp = requests.request("GET",
-                                url,
-                                auth=(conf['D42_USER'], conf['D42_PWD']),
-                                verify=False)
+        resp = get_session(conf).request("GET",
+                                         url,
+                                         verify=False)
 
         if resp.status_code != 200:
             raise AnsibleError("API Call failed with status code: " + str(resp.status_code))
@@ -71,13 +245,74 @@ class LookupModule(LookupBase):
         else:
             raise AnsibleError("No password found for user: %s and device: %s" % (username, device))
 
+    def getUserPasses(self, conf, pairs, username=None):
+        """
+        Resolve the passwords of many (device, username) pairs with one paged list query
+        per username, split by device on the controller. pairs may also be plain device
+        names when a single username is given. Like getUserPass, a pair must match
+        exactly one password. Returns the passwords in input order.
+        """
+        pairs = [(p, username) if not isinstance(p, (list, tuple)) else tuple(p) for p in pairs]
+        for device, user in pairs:
+            if not user:
+                raise AnsibleError("No username given for device: %s" % device)
+
+        users = list(OrderedDict.fromkeys(user for device, user in pairs))
+        wanted = set(pairs)
+        found = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(D42_WORKERS, len(users)))) as pool:
+            for user, entries in zip(users, pool.map(lambda user: self._userPasswords(conf, user), users)):
+                for entry in entries:
+                    for device in set(self._password_devices(entry)):
+                        if (device, user) in wanted:
+                            found.setdefault((device, user), []).append(entry["password"])
+
+        ret = []
+        for device, user in pairs:
+            passwords = found.get((device, user))
+            if not passwords:
+                raise AnsibleError("No password found for user: %s and device: %s" % (user, device))
+            if len(passwords) > 1:
+                raise AnsibleError("Multiple users found for device: %s" % device)
+            ret.append(passwords[0])
+        return ret
+
+    def _userPasswords(self, conf, user):
+        # every password entry of user, paged with limit/offset
+        url = conf['D42_URL'] + "/api/1.0/passwords/"
+        entries = []
+        while True:
+            resp = get_session(conf).request("GET",
+                                             url,
+                                             params={'plain_text': 'yes', 'username': user,
+                                                     'limit': D42_PAGE_SIZE, 'offset': len(entries)},
+                                             verify=False)
+
+            if resp.status_code != 200:
+                raise AnsibleError("API Call failed with status code: " + str(resp.status_code))
+            if not resp.text:
+                raise AnsibleError("Something went wrong!")
+
+            page = json.loads(resp.text)
+            page_entries = page["Passwords"]
+            entries.extend(page_entries)
+            if not page_entries or len(entries) >= page.get("total_count", 0):
+                return entries
+
+    @staticmethod
+    def _password_devices(entry):
+        # the device a password belongs to is a name, a dict or a list of either
+        devices = entry.get("device") or []
+        if not isinstance(devices, list):
+            devices = [devices]
+        return [d.get("name") if isinstance(d, dict) else d for d in devices]
+
     def getServicePass(self, conf, username, label, category):
         url = conf['D42_URL'] + "/api/1.0/passwords/?plain_text=yes&username=" + username + "&label=" + label + "&category=" + category
 
-        resp = requests.request("GET",
-                                url,
-                                auth=(conf['D42_USER'], conf['D42_PWD']),
-                                verify=False)
+        resp = get_session(conf).request("GET",
+                                         url,
+                                         verify=False)
 
         if resp.status_code != 200:
             raise AnsibleError("API Call failed with status code: " + str(resp.status_code))
@@ -93,41 +328,139 @@ class LookupModule(LookupBase):
         else:
             raise AnsibleError("No password found for user: %s and device: %s" % (username, device))
 
-    def runDoql(self, conf, query, output_type):
+    def runDoql(self, conf, query, output_type, dest=None, page_size=None, order_by=None):
+        """
+        Run a DOQL query. output_type is one of string, list, list_dicts,
+        csv_file or jsonl_file. The *_file types stream the rows to dest and
+        return its path and row count instead of the rows themselves.
+        page_size splits list_dicts and *_file queries into LIMIT/OFFSET pages on the server,
+        ordered by order_by, a comma separated list of result columns that is unique per row.
+        """
+        query = query.replace("@", "'")
+        if page_size:
+            self._checkOrder(order_by)
+
+        if output_type in ('csv_file', 'jsonl_file'):
+            if not dest:
+                raise AnsibleError("DOQL output type %s needs a destination path" % output_type)
+            rows = self.writeDoql(self.iterDoql(conf, query, page_size, order_by), dest, output_type)
+            return [{'path': dest, 'rows': rows}]
+
+        if output_type not in ('string', 'list'):
+            output_list = list(self.iterDoql(conf, query, page_size, order_by))
+            if len(output_list) == 1:
+                output_list = [output_list,]
+            return output_list
+
+        resp = self._doqlRequest(conf, query, 'no')
+        if output_type == 'string':
+            return [resp.text.replace('\n', ''),]
+        return resp.text.split('\n')
+
+    def iterDoql(self, conf, query, page_size=None, order_by=None):
+        """
+        Yield the rows of a DOQL query as dicts, parsing the csv as it arrives from the socket.
+        """
+        if not page_size:
+            for row in self._doqlRows(conf, query):
+                yield row
+            return
+
+        self._checkOrder(order_by)
+        page_size = int(page_size)
+        offset = 0
+        while True:
+            paged = "SELECT * FROM (%s) AS doql_page ORDER BY %s LIMIT %d OFFSET %d" % (
+                query.rstrip('; \n'), order_by, page_size, offset)
+            count = 0
+            for row in self._doqlRows(conf, paged):
+                count += 1
+                yield row
+            if count < page_size:
+                return
+            offset += page_size
+
+    @staticmethod
+    def _checkOrder(order_by):
+        # rows of separate queries only come back in the same order when it is spelled out
+        if not order_by or not re.match(r'^\s*\w+(\s+(asc|desc))?(\s*,\s*\w+(\s+(asc|desc))?)*\s*$', order_by, re.I):
+            raise AnsibleError("Paged DOQL needs order_by, the result columns that identify a row, e.g. order_by='device_pk'")
+
+    def _doqlRequest(self, conf, query, header, stream=False):
         url = conf['D42_URL'] + "/services/data/v1.0/query/"
 
         post_data = {
-            "query": query.replace("@", "'"),
-            "header": 'yes' if output_type == 'list_dicts' else 'no'
+            "query": query,
+            "header": header
         }
 
-        resp = requests.request("POST",
-                                url,
-                                auth=(conf['D42_USER'], conf['D42_PWD']),
-                                data=post_data,
-                                verify=False)
+        resp = get_session(conf).request("POST",
+                                         url,
+                                         data=post_data,
+                                         stream=stream,
+                                         verify=False)
 
         if resp.status_code != 200:
+            resp.close()
             raise AnsibleError("API Call failed with status code: " + str(resp.status_code))
+        return resp
 
-        if output_type == 'string':
-            return [resp.text.replace('\n', ''),]
-        elif output_type == 'list':
-            return resp.text.split('\n')
+    def _doqlRows(self, conf, query):
+        resp = self._doqlRequest(conf, query, 'yes', stream=True)
+        try:
+            resp.raw.decode_content = True
+            lines = io.TextIOWrapper(resp.raw, encoding=resp.encoding or 'utf-8', newline='')
+            for row in csv.DictReader(lines, quotechar='"', delimiter=',', skipinitialspace=True, dialect='excel'):
+                yield row
+        finally:
+            resp.close()
+
+    @staticmethod
+    def writeDoql(rows, dest, output_type):
+        count = 0
+        with open(dest, 'w', newline='') as f:
+            writer = None
+            for row in rows:
+                if output_type == 'jsonl_file':
+                    f.write(json.dumps(row) + '\n')
+                else:
+                    if writer is None:
+                        writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+                        writer.writeheader()
+                    writer.writerow(row)
+                count += 1
+        return count
+
+    def devicesInfo(self, conf, devices, attribute):
+        """
+        Resolve one attribute for many devices with a DOQL query per D42_BATCH_SIZE names.
+        Only the attributes of D42_BATCH_INFO are supported, they are read from the
+        view_device_v1 column holding the same value as the /devices/id/ field that
+        deviceInfo returns. Returns values in input order, None for devices that are
+        not in Device42.
+        """
+        if attribute not in D42_BATCH_INFO:
+            raise AnsibleError("d42info attribute %s is not available in batch mode, use one of %s or single lookups"
+                               % (attribute, ', '.join(sorted(D42_BATCH_INFO))))
+        column, convert = D42_BATCH_INFO[attribute]
+
+        names = sorted(set(devices))
+        found = {}
+        for i in range(0, len(names), D42_BATCH_SIZE):
+            chunk = names[i:i + D42_BATCH_SIZE]
+            query = "SELECT name, %s FROM view_device_v1 WHERE name IN (%s)" % (
+                column, ", ".join("'%s'" % n.replace("'", "''") for n in chunk))
+            for row in self.iterDoql(conf, query):
+                found[row['name']] = convert(row[column])
 
-        return self.get_list_from_csv(resp.text)
+        return [found.get(device) for device in devices]
 
     def deviceInfo(self, conf, device, scrapedMeta):
         url = conf['D42_URL'] + "/api/1.0/devices/?name=" + device
-        device_name_blob = requests.request("GET",
-                                                  url,
-                                                  auth=(conf['D42_USER'], conf['D42_PWD'])
-                                                  ).json()
+        session = get_session(conf)
+        device_name_blob = session.request("GET", url).json()
         device_id = device_name_blob['Devices'][0]['device_id']
         device_url = conf['D42_URL'] + "/api/1.0/devices/id/" + str(device_id)
-        device_info_blob = requests.request("GET",
-                                            device_url,
-                                            auth=(conf['D42_USER'], conf['D42_PWD'])
-                                            ).json()
+        device_info_blob = session.request("GET", device_url).json()
         requested_info = device_info_blob[scrapedMeta]
         return [requested_info]
@@ -0,0 +1,171 @@
+import os, requests, threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# connection pool settings, shared by every d42 plugin in this worker process
+D42_POOL_SIZE = int(os.getenv('D42_POOL_SIZE', 10))
+D42_RETRIES = int(os.getenv('D42_RETRIES', 3))
+D42_BACKOFF = float(os.getenv('D42_BACKOFF', 0.5))
+D42_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# certificate checks of the Device42 api: true, false or the path of a ca bundle.
+# D42_SKIP_SSL_CHECK=True, which the d42 lookup honours as well, turns them off
+D42_VERIFY = os.getenv('D42_VERIFY', 'False' if os.getenv('D42_SKIP_SSL_CHECK') == 'True' else 'True')
+D42_VERIFY = {'true': True, 'yes': True, 'false': False, 'no': False}.get(D42_VERIFY.lower(), D42_VERIFY)
+
+# concurrent requests of bulk operations, kept below the pool size
+D42_WORKERS = int(os.getenv('D42_WORKERS', min(8, D42_POOL_SIZE)))
+
+# port labels that are never released or shut down
+D42_IPMI_LABELS = ('ipmi', 'IPMI')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_conf(url=None, username=None, password=None, verify=None):
+    """
+    Connection settings in the form get_session expects, defaulting to the D42_* environment.
+    """
+    return {
+        'D42_URL': (url or os.getenv('D42_URL', 'https://device42.example.com/')).rstrip('/'),
+        'D42_USER': username or os.getenv('D42_USERNAME'),
+        'D42_PWD': password or os.getenv('D42_PASSWORD'),
+        'D42_VERIFY': D42_VERIFY if verify is None else verify
+    }
+
+
+def get_session(conf):
+    """
+    Return the keep-alive session for conf['D42_URL'], creating it on first use.
+    Sessions retry with backoff on 429/5xx answers and live for the whole process.
+    """
+    key = (conf['D42_URL'], conf['D42_USER'])
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            retry_args = dict(total=D42_RETRIES,
+                              backoff_factor=D42_BACKOFF,
+                              status_forcelist=D42_RETRY_STATUS,
+                              raise_on_status=False)
+            # every method is retried: DOQL queries are read only POSTs, and the only
+            # writing POST, release_ip, sets an absolute state (available, no device)
+            # that a repeated request leaves unchanged
+            try:
+                retry = Retry(allowed_methods=None, **retry_args)
+            except TypeError:
+                # urllib3 < 1.26
+                retry = Retry(method_whitelist=None, **retry_args)
+            adapter = HTTPAdapter(pool_connections=D42_POOL_SIZE,
+                                  pool_maxsize=D42_POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.auth = (conf['D42_USER'], conf['D42_PWD'])
+            _sessions[key] = session
+    return session
+
+
+def device_facts(conf, hostname, domain='.example.com', macs=True):
+    """
+    Everything the decommission play uses about a device: one request for the device,
+    a second only when Device42 knows it by its short name, and one for the switch
+    ports of physical devices. Devices missing from Device42 give present=False.
+    """
+    facts = device_facts_missing(hostname, domain)
+    short = facts['name']
+    session = get_session(conf)
+
+    device = None
+    for name in (short + domain, short):
+        resp = session.get(conf['D42_URL'] + "/api/1.0/devices/name/%s/" % name, verify=conf.get('D42_VERIFY', D42_VERIFY))
+        facts['msg'] = "%s %s" % (resp.status_code, resp.reason)
+        if resp.status_code == 200:
+            device = resp.json()
+            facts['name'] = name
+            break
+    if device is None:
+        return facts
+
+    facts.update({
+        'present': True,
+        'type': device.get('type'),
+        'hw_model': device.get('hw_model'),
+        'tags': device.get('tags') or [],
+        'ips': [{'ip': ip.get('ip'), 'label': ip.get('label')} for ip in device.get('ip_addresses') or []],
+    })
+    facts['release_ips'] = [ip['ip'] for ip in facts['ips'] if ip['label'] not in D42_IPMI_LABELS]
+
+    if macs and facts['type'] != 'virtual':
+        resp = session.get(conf['D42_URL'] + "/api/1.0/macs/", params={'device': facts['name']}, verify=conf.get('D42_VERIFY', D42_VERIFY))
+        if resp.status_code == 200:
+            facts['ports'] = device_ports(resp.json().get('macaddresses') or [])
+    return facts
+
+
+def device_facts_missing(hostname, domain='.example.com'):
+    """
+    device_facts of a device Device42 does not know
+    """
+    short = hostname[:-len(domain)] if domain and hostname.endswith(domain) else hostname
+    return {
+        'present': False,
+        'name': short,
+        'msg': None,
+        'type': None,
+        'hw_model': None,
+        'tags': [],
+        'ips': [],
+        'release_ips': [],
+        'ports': [],
+    }
+
+
+def device_ports(macaddresses):
+    """
+    Switch ports of the non ipmi macs of a device
+    """
+    ports = []
+    for mac in macaddresses:
+        port = mac.get('port')
+        if not port or mac.get('port_name') in D42_IPMI_LABELS:
+            continue
+        ports.append({
+            'd42_host_name': (mac.get('device') or {}).get('name'),
+            'd42_host_mac': mac.get('macaddress'),
+            'd42_host_switch': (port.get('switch') or {}).get('name'),
+            'd42_host_port': port.get('port'),
+        })
+    return ports
+
+
+def release_ip(conf, ip):
+    """
+    Mark ip available again and clear its device, returns {'ok', 'status', 'msg'}.
+    Releasing twice gives the same result, so the session may retry it on 5xx answers.
+    """
+    try:
+        resp = get_session(conf).post(conf['D42_URL'] + "/api/1.0/ips/",
+                                      data={'ipaddress': ip, 'available': 'yes', 'clear_all': 'yes'},
+                                      verify=conf.get('D42_VERIFY', D42_VERIFY))
+    except requests.exceptions.RequestException as e:
+        return {'ok': False, 'status': None, 'msg': str(e)}
+    try:
+        msg = resp.json().get('msg')
+    except ValueError:
+        msg = resp.text
+    return {'ok': resp.status_code == 200, 'status': resp.status_code, 'msg': msg}
+
+
+def release_ips(conf, ips, workers=D42_WORKERS):
+    """
+    Release many ips over the pooled session, at most workers at a time.
+    Returns {ip: release_ip result}, each ip is released once.
+    """
+    ips = sorted(set(ips))
+    if not ips:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ips)))) as pool:
+        return dict(zip(ips, pool.map(lambda ip: release_ip(conf, ip), ips)))
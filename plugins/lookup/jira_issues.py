@@ -0,0 +1,113 @@
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+import bisect, os, re, requests
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# issues per search request, Jira caps this server side (usually at 100 or 1000)
+JIRA_PAGE_SIZE = int(os.getenv('JIRA_PAGE_SIZE', 1000))
+JIRA_TIMEOUT = int(os.getenv('JIRA_TIMEOUT', 60))
+
+# fields searched for host names, customfield_15918 holds the hosts of a decommission issue
+JIRA_HOST_FIELDS = ['summary', 'customfield_15918']
+
+# what Jira's text search treats as one word of a summary
+_WORD = re.compile(r'[\w.-]+')
+
+
+class LookupModule(LookupBase):
+    """
+    Find the issue of many hosts with one paginated JQL search.
+
+    lookup('jira_issues', jql, url=jira_url, username=jira_user, password=jira_pass,
+           hosts=ansible_play_hosts_all, strip='.example.com')
+
+    returns {host: issue key} for the hosts found in the summary or host fields of an
+    issue, matching words by prefix like summary~'host*' does. Hosts without an
+    issue are left out. Without hosts the {word: issue key} index itself is returned.
+    """
+
+    def run(self, terms, variables=None, **kwargs):
+        conf = {
+            'url': kwargs.get('url') or os.getenv('JIRA_URL', 'https://bugs.example.com'),
+            'username': kwargs.get('username') or os.getenv('JIRA_USERNAME'),
+            'password': kwargs.get('password') or os.getenv('JIRA_PASSWORD'),
+            'fields': kwargs.get('fields') or JIRA_HOST_FIELDS,
+        }
+        if not terms:
+            raise AnsibleError("jira_issues needs a JQL query")
+
+        index = self.buildIndex(self.searchIssues(conf, terms[0]), conf['fields'])
+        hosts = kwargs.get('hosts')
+        if hosts is None:
+            return [index]
+        return [self.matchHosts(index, hosts, kwargs.get('strip', ''))]
+
+    def searchIssues(self, conf, jql):
+        """
+        Yield every issue matching jql, one request per JIRA_PAGE_SIZE issues.
+        """
+        session = requests.Session()
+        session.auth = (conf['username'], conf['password'])
+        url = conf['url'].rstrip('/') + "/rest/api/2/search"
+        start = 0
+        try:
+            while True:
+                resp = session.get(url,
+                                   params={'jql': jql,
+                                           'startAt': start,
+                                           'maxResults': JIRA_PAGE_SIZE,
+                                           'fields': ','.join(conf['fields'])},
+                                   timeout=JIRA_TIMEOUT)
+                if resp.status_code != 200:
+                    raise AnsibleError("Jira search failed with status code: %s %s" % (resp.status_code, resp.text[:200]))
+                page = resp.json()
+                issues = page.get('issues', [])
+                display.vvv("jira_issues: %d-%d of %d issues" % (start, start + len(issues), page.get('total', 0)))
+                for issue in issues:
+                    yield issue
+                start += len(issues)
+                if not issues or start >= page.get('total', 0):
+                    return
+        except requests.exceptions.RequestException as e:
+            raise AnsibleError("Jira search failed: %s" % e)
+        finally:
+            session.close()
+
+    @staticmethod
+    def buildIndex(issues, fields):
+        """
+        {word: issue key} of the words in the host fields of issues, the first issue wins
+        """
+        index = {}
+        for issue in issues:
+            for field in fields:
+                value = issue.get('fields', {}).get(field)
+                if isinstance(value, list):
+                    value = ' '.join(str(v.get('value', v) if isinstance(v, dict) else v) for v in value)
+                elif isinstance(value, dict):
+                    value = value.get('value', '')
+                for word in _WORD.findall(str(value or '').lower()):
+                    index.setdefault(word, issue['key'])
+        return index
+
+    @staticmethod
+    def matchHosts(index, hosts, strip=''):
+        """
+        {host: issue key} of the hosts whose stripped name starts a word of the index
+        """
+        words = sorted(index)
+        found = {}
+        for host in hosts:
+            name = host.lower()
+            if strip and name.endswith(strip.lower()):
+                name = name[:-len(strip)]
+            i = bisect.bisect_left(words, name)
+            # every word with this prefix sorts right after it, take the first match
+            if name and i < len(words) and words[i].startswith(name):
+                found[host] = index[words[i]]
+        return found